@@ -107,6 +107,10 @@ function! UltiSnipsAddFiletypes(filetypes)
 endfunction
 command! -nargs=1 UltiSnipsAddFiletypes :call UltiSnipsAddFiletypes(<q-args>)
 
+" purge or rebuild the cache of parsed snippet files
+command! -nargs=0 UltiSnipsPurgeCache :exec g:_uspy "UltiSnips_Manager.purge_cache()"
+command! -nargs=0 UltiSnipsRebuildCache :exec g:_uspy "UltiSnips_Manager.rebuild_cache()"
+
 "" }}}
 
 " FUNCTIONS {{{
@@ -203,12 +207,18 @@ endf
 function! UltiSnips_CursorMoved()
     exec g:_uspy "UltiSnips_Manager.cursor_moved()"
 endf
+function! UltiSnips_TextChanged()
+    exec g:_uspy "UltiSnips_Manager.text_changed()"
+endf
 function! UltiSnips_EnteredInsertMode()
     exec g:_uspy "UltiSnips_Manager.entered_insert_mode()"
 endf
 function! UltiSnips_LeavingBuffer()
     exec g:_uspy "UltiSnips_Manager.leaving_buffer()"
 endf
+function! UltiSnips_ShellCodeTimer(timer)
+    exec g:_uspy "UltiSnips_Manager.shell_code_timer()"
+endf
 " }}}
 
 "" STARTUP CODE {{{
@@ -224,6 +234,11 @@ exec g:_uspy "UltiSnips_Manager.backward_trigger = vim.eval('g:UltiSnipsJumpBack
 
 au CursorMovedI * call UltiSnips_CursorMoved()
 au CursorMoved * call UltiSnips_CursorMoved()
+" Changes that do not move the cursor (like <Del>) are only seen through these
+if exists('##TextChangedI')
+    au TextChangedI * call UltiSnips_TextChanged()
+    au TextChanged * call UltiSnips_TextChanged()
+endif
 au BufLeave * call UltiSnips_LeavingBuffer()
 
 call UltiSnips_MapKeys()
@@ -3,16 +3,25 @@
 
 from functools import wraps
 from collections import deque, defaultdict
-import glob
+import bisect
+import fnmatch
 import hashlib
 import os
 import re
+import stat
+import time
 import traceback
 
 from UltiSnips.compatibility import as_unicode, byte2col
-from UltiSnips._diff import diff, guess_edit
+from UltiSnips._cache import SnippetFileCache
+from UltiSnips._diff import apply_writes, line_diff, guess_edit
+from UltiSnips._watcher import create_watcher
 from UltiSnips.geometry import Position
 from UltiSnips.text_objects import SnippetInstance
+from UltiSnips.text_objects._lexer import compile_tokens
+from UltiSnips.text_objects._python_code import forget_global_namespaces
+from UltiSnips.text_objects._shell_code import finished_shell_code, \
+        shell_code_running
 from UltiSnips.util import IndentUtil
 import UltiSnips._vim as _vim
 
@@ -34,6 +43,132 @@ Following is the full stack trace:
             _vim.new_scratch_buffer(s)
     return wrapper
 
+def _words_for_line(before, num_words):
+    """ Gets the final num_words words from before. """
+    if not len(before):
+        return ''
+
+    word_list = before.split()
+    if len(word_list) <= num_words:
+        return before.strip()
+    else:
+        before_words = before
+        for i in range(-1, -(num_words + 1), -1):
+            left = before_words.rfind(word_list[i])
+            before_words = before_words[:left]
+        return before[len(before_words):].strip()
+
+# Backreferences, named groups, conditionals and inline flags change their
+# meaning or become invalid when a pattern is put into an alternation.
+_UNCOMBINABLE_RE = re.compile(r"\\[1-9]|\(\?(?![:=!]|<[=!])")
+
+def _is_combinable(pattern):
+    if _UNCOMBINABLE_RE.search(pattern):
+        return False
+    try:
+        re.compile(pattern)
+    except re.error:
+        return False
+    return True
+
+def _combine_regexes(patterns):
+    """
+    Returns one compiled regular expression that can be found at the end of a
+    line if any of the given patterns can. Patterns that can not be combined
+    are skipped. Returns None if nothing could be combined.
+    """
+    alternatives = [ "(?:%s)" % p for p in patterns if _is_combinable(p) ]
+    if not alternatives:
+        return None
+    try:
+        return re.compile("(?:%s)\\Z" % "|".join(alternatives))
+    except (re.error, AssertionError): # Too many groups on old Pythons
+        return None
+
+class _TriggerIndex(object):
+    """
+    Sorts the snippets of a _SnippetDictionary into buckets by the way their
+    trigger is matched. Plain triggers are looked up by their text, only
+    regular expression, word and inword snippets need to be tried one by one.
+
+    For listing, all non regular expression triggers are also kept in sorted
+    arrays (one per number of words in the trigger), so that finding all
+    triggers starting with a prefix is a range query.
+
+    All regular expression triggers are combined into one alternation that is
+    anchored at the end of the line. If it is not found, none of the
+    combined snippets can match and they are not tried one by one.
+    """
+    def __init__(self, snippets):
+        self._plain = defaultdict(list)
+        self._word_counts = set()
+        self._regex = []
+        self._word = []
+        self._inword = []
+        self._by_prefix = defaultdict(list)
+
+        for idx, s in enumerate(snippets):
+            entry = (idx, s)
+            if "r" in s._opts:
+                self._regex.append(entry)
+                continue
+            num_words = len(s.trigger.split())
+            self._by_prefix[num_words].append((s.trigger, idx, s))
+            if "w" in s._opts:
+                self._word.append(entry)
+            elif "i" in s._opts:
+                self._inword.append(entry)
+            else:
+                self._plain[num_words, s.trigger].append(entry)
+                self._word_counts.add(num_words)
+
+        self._prefix_triggers = {}
+        for num_words, entries in self._by_prefix.items():
+            entries.sort(key=lambda entry: entry[:2])
+            self._prefix_triggers[num_words] = [ e[0] for e in entries ]
+
+        self.has_overwrites = any(s.overwrites_previous for s in snippets)
+
+        self._combined_re = _combine_regexes(
+                [ s.trigger for idx, s in self._regex ])
+        self._uncombined_regex = [ (idx, s) for idx, s in self._regex
+                if not _is_combinable(s.trigger) ]
+
+    def _regex_candidates(self, before):
+        """Returns the regular expression snippets that might match before."""
+        if self._combined_re is None or self._combined_re.search(before):
+            return self._regex
+        return self._uncombined_regex
+
+    def candidates(self, before):
+        """Returns the snippets that might match before in definition
+        order. They still need to be checked with Snippet.matches."""
+        rv = self._regex_candidates(before) + self._word + self._inword
+        for num_words in self._word_counts:
+            rv.extend(self._plain.get(
+                (num_words, _words_for_line(before, num_words)), ()))
+        rv.sort(key=lambda entry: entry[0])
+        return [ s for idx, s in rv ]
+
+    def possible_candidates(self, before):
+        """Returns the snippets that could match before once more is typed,
+        sorted by trigger. They still need to be checked with
+        Snippet.could_match."""
+        if before and before[-1] in (" ", "\t"):
+            before = ""
+
+        rv = [ (s.trigger, idx, s)
+                for idx, s in self._regex_candidates(before) ]
+        for num_words, entries in self._by_prefix.items():
+            prefix = _words_for_line(before, num_words)
+            triggers = self._prefix_triggers[num_words]
+            i = bisect.bisect_left(triggers, prefix)
+            while i < len(triggers) and triggers[i].startswith(prefix):
+                rv.append(entries[i])
+                i += 1
+        rv.sort(key=lambda entry: entry[:2])
+        return [ s for t, idx, s in rv ]
+
 class _SnippetDictionary(object):
     def __init__(self, *args, **kwargs):
         self._added = []
@@ -47,18 +182,32 @@ class _SnippetDictionary(object):
                 self.addfile(fn)
         else:
             self._added.append(s)
+        self._index = None
 
     def get_matching_snippets(self, trigger, potentially):
-        """Returns all snippets matching the given trigger."""
+        """Returns all snippets matching the given trigger. If potentially is
+        True, the snippets that could match are returned sorted by their
+        trigger."""
+        if self._index is None:
+            self._index = _TriggerIndex(self.snippets)
         if not potentially:
-            return [ s for s in self.snippets if s.matches(trigger) ]
+            return [ s for s in self._index.candidates(trigger)
+                    if s.matches(trigger) ]
         else:
-            return [ s for s in self.snippets if s.could_match(trigger) ]
+            return [ s for s in self._index.possible_candidates(trigger)
+                    if s.could_match(trigger) ]
 
     @property
     def snippets(self):
         return self._added + self._snippets
 
+    @property
+    def has_overwrites(self):
+        """True if any of the snippets overwrites previous ones."""
+        if self._index is None:
+            self._index = _TriggerIndex(self.snippets)
+        return self._index.has_overwrites
+
     def clear_snippets(self, triggers=[]):
         """Remove all snippets that match each trigger in triggers.
             When triggers is empty, removes all snippets.
@@ -73,6 +222,7 @@ class _SnippetDictionary(object):
         else:
             self._snippets = []
             self._added = []
+        self._index = None
 
     @property
     def files(self):
@@ -82,6 +232,7 @@ class _SnippetDictionary(object):
         self._snippets = []
         self._extends = []
         self._files = {}
+        self._index = None
 
 
     def _hash(self, path):
@@ -90,14 +241,35 @@ class _SnippetDictionary(object):
 
         return hashlib.sha1(open(path, "rb").read()).hexdigest()
 
+    def _stat(self, path):
+        """Returns what os.stat tells about a change of the file at path or
+        None if it is not a file."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return (getattr(st, "st_mtime_ns", st.st_mtime), st.st_size, st.st_ino)
 
     def addfile(self, path):
-        self.files[path] = self._hash(path)
+        # Stat before hashing, so that a change in between is noticed
+        st = self._stat(path)
+        self.files[path] = (st, self._hash(path))
 
     def needs_update(self):
-        for path, hash in self.files.items():
-            if not hash or hash != self._hash(path):
+        """Returns True if any of the files has changed. Files are only read
+        and hashed if their stat information changed."""
+        for path, (st, hash) in list(self.files.items()):
+            cur_st = self._stat(path)
+            if not hash or cur_st is None:
+                return True
+            if cur_st == st:
+                continue
+            if hash != self._hash(path):
                 return True
+            # Only touched, remember the new stat information
+            self.files[path] = (cur_st, hash)
         return False
 
     def extends():
@@ -109,11 +281,21 @@ class _SnippetDictionary(object):
     extends = property(**extends())
 
 class _SnippetsFileParser(object):
+    """
+    Parses a snippet file into a list of records that are later added to the
+    SnippetManager in order. A record is one of
+        ["extends", filetypes]
+        ["snippet", trigger, value, description, options]
+        ["clearsnippets", triggers]
+    The global blocks of the file are collected separately.
+    """
     def __init__(self, ft, fn, snip_manager, file_data=None):
         self._sm = snip_manager
         self._ft = ft
         self._fn = fn
         self._globals = {}
+        self._records = []
+        self.had_errors = False
         if file_data is None:
             self._lines = open(fn).readlines()
         else:
@@ -122,6 +304,7 @@ class _SnippetsFileParser(object):
         self._idx = 0
 
     def _error(self, msg):
+        self.had_errors = True
         fn = _vim.eval("""fnamemodify(%s, ":~:.")""" % _vim.escape(self._fn))
         self._sm._error("%s in %s(%d)" % (msg, fn, self._idx + 1))
 
@@ -212,27 +395,29 @@ class _SnippetsFileParser(object):
                 self._globals[trig] = []
             self._globals[trig].append(cv)
         elif snip == "snippet":
-            self._sm.add_snippet(trig, cv, desc, opts, self._ft, self._globals, fn=self._fn)
+            self._records.append(["snippet", trig, cv, desc, opts])
         else:
             self._error("Invalid snippet type: '%s'" % snip)
 
     def parse(self):
+        """Returns the records and the globals of the file."""
         while self._line():
             head, tail = self._line_head_tail()
             if head == "extends":
                 if tail:
-                    self._sm.add_extending_info(self._ft,
-                        [ p.strip() for p in tail.split(',') ])
+                    self._records.append(["extends",
+                        [ p.strip() for p in tail.split(',') ]])
                 else:
                     self._error("'extends' without file types")
             elif head in ("snippet", "global"):
                 self._parse_snippet()
             elif head == "clearsnippets":
-                self._sm.clear_snippets(tail.split(), self._ft)
+                self._records.append(["clearsnippets", tail.split()])
             elif head and not head.startswith('#'):
                 self._error("Invalid line %r" % self._line().rstrip())
                 break
             self._goto_next_line()
+        return self._records, self._globals
 
 
 
@@ -248,6 +433,7 @@ class Snippet(object):
         self._matched = ""
         self._last_re = None
         self._globals = globals
+        self._compiled = {}
 
     def __repr__(self):
         return "Snippet(%s,%s,%s)" % (self._t,self._d,self._opts)
@@ -257,22 +443,10 @@ class Snippet(object):
         If num_words is None, then use the number of words in
         the trigger.
         """
-        words = ''
-        if not len(before):
-            return ''
-
         if num_words is None:
             num_words = len(self._t.split())
 
-        word_list = before.split()
-        if len(word_list) <= num_words:
-            return before.strip()
-        else:
-            before_words = before
-            for i in range(-1, -(num_words + 1), -1):
-                left = before_words.rfind(word_list[i])
-                before_words = before_words[:left]
-            return before[len(before_words):].strip()
+        return _words_for_line(before, num_words)
 
     def _re_match(self, trigger):
         """ Test if a the current regex trigger matches
@@ -412,15 +586,27 @@ class Snippet(object):
             v.append(line_ind + line[tabs:])
         v = '\n'.join(v)
 
+        compiled = self._compiled_body(v, indent)
         if parent is None:
             si = SnippetInstance(None, indent, v, start, end, visual_content = visual_content,
-                    last_re = self._last_re, globals = self._globals)
+                    last_re = self._last_re, globals = self._globals,
+                    compiled = compiled)
         else:
             si = SnippetInstance(parent, indent, v, start, end, visual_content,
-                    last_re = self._last_re, globals = self._globals)
+                    last_re = self._last_re, globals = self._globals,
+                    compiled = compiled)
 
         return si
 
+    def _compiled_body(self, text, indent):
+        """ Returns the tokens of the indented body text, see compile_tokens.
+        They are only computed on first use.
+        """
+        key = (text, indent)
+        if key not in self._compiled:
+            self._compiled[key] = compile_tokens(text, indent)
+        return self._compiled[key]
+
 class VisualContentPreserver(object):
     def __init__(self):
         self.reset()
@@ -484,11 +670,38 @@ class VimState(object):
     def remember_position(self):
         self._poss.append(_VimPosition())
 
-    def remember_buffer(self, to):
-        self._lvb = _vim.buf[to.start.line:to.end.line+1]
+    def remember_buffer(self, to, read = None, writes = ()):
+        """
+        Remembers the lines of the text object to. read can be a tuple
+        (first_line, lines, buffer_length) of lines that were read from the
+        buffer before, and writes the changes made to the buffer since then
+        as returned by VimBuffer.recorded_writes. The writes are then applied
+        to the read lines instead of reading the buffer again. If they are
+        incomplete or do not fit, the buffer is read.
+        """
+        start, end = to.start.line, to.end.line + 1
+        lines = None
+        if read is not None and writes is not None:
+            first, lines, length = read
+            lines = apply_writes(first, lines, writes)
+            for i, j, new_lines in writes:
+                length += len(new_lines) - (j - i)
+            if lines is not None and (start < first or
+                    end - first > len(lines) or length != len(_vim.buf)):
+                lines = None
+        if lines is None:
+            self._lvb = tuple(_vim.buf[start:end])
+        else:
+            self._lvb = tuple(lines[start - first:end - first])
         self._lvb_len = len(_vim.buf)
+        self._lvb_tick = _vim.buf.changedtick
         self.remember_position()
 
+    @property
+    def buffer_changed(self):
+        """True if the buffer was changed since it was remembered."""
+        return self._lvb is None or _vim.buf.changedtick != self._lvb_tick
+
     @property
     def diff_in_buffer_length(self):
         return len(_vim.buf) - self._lvb_len
@@ -501,13 +714,16 @@ class VimState(object):
         return self._poss[-2]
     @property
     def remembered_buffer(self):
-        return self._lvb[:]
+        """The remembered lines as a tuple. It is never changed in place."""
+        return self._lvb
 
 
 class SnippetManager(object):
     def __init__(self):
         self._supertab_keys = None
         self._csnippets = []
+        self._watcher = None
+        self._shell_code_timer = False # Vim will call shell_code_timer
 
         self.reset()
 
@@ -517,10 +733,19 @@ class SnippetManager(object):
         self._test_error = test_error
         self._snippets = {}
         self._filetypes = defaultdict(lambda: ['all'])
+        self._filetype_chains = {}
+        self._last_update_check = {}
+        # The snippet directories by filetype that were given to the watcher
+        self._watched_dirs = {}
+        self._snippet_dirs_cache = (None, [])
+        self._dir_listings = {}
         self._visual_content = VisualContentPreserver()
+        forget_global_namespaces()
+        if self._watcher is not None:
+            self._watcher.clear()
 
-        while len(self._csnippets):
-            self._current_snippet_is_done()
+        # The output of shell code that still runs is dropped
+        del self._csnippets[:]
 
         self._reinit()
 
@@ -544,9 +769,6 @@ class SnippetManager(object):
         before, after = _vim.buf.current_line_splitted
         snippets = self._snips(before, True)
 
-        # Sort snippets alphabetically
-        snippets.sort(key=lambda x: x.trigger)
-
         if not snippets:
             return True
 
@@ -584,6 +806,7 @@ class SnippetManager(object):
     def snippet_dict(self, ft):
         if ft not in self._snippets:
             self._snippets[ft] = _SnippetDictionary()
+            self._filetype_chains.clear()
         return self._snippets[ft]
 
     @err_to_scratch_buffer
@@ -615,6 +838,7 @@ class SnippetManager(object):
     def clear_snippets(self, triggers = [], ft = "all"):
         if ft in self._snippets:
             self._snippets[ft].clear_snippets(triggers)
+        self._filetype_chains.clear()
 
     @err_to_scratch_buffer
     def add_extending_info(self, ft, parents):
@@ -624,6 +848,7 @@ class SnippetManager(object):
                 continue
 
             sd.extends.append(p)
+        self._filetype_chains.clear()
 
     @err_to_scratch_buffer
     def cursor_moved(self):
@@ -634,11 +859,41 @@ class SnippetManager(object):
         if self._ignore_movements:
             self._ignore_movements = False
             return
+        # Vim does not send TextChangedI if we already left insert mode
+        # again, the user is moving on now.
+        self._ignore_text_change = False
+
+        self._replay_changes()
+
+    @err_to_scratch_buffer
+    def text_changed(self):
+        """
+        Called from TextChanged and TextChangedI. Changes that do not move the
+        cursor (like <Del>) are only seen here.
+        """
+        self._vstate.remember_position()
+        if _vim.eval("mode()") not in 'in':
+            return
+
+        if self._ignore_text_change:
+            self._ignore_text_change = False
+            return
 
-        if self._csnippets:
+        self._replay_changes()
+
+    def _replay_changes(self):
+        """
+        Replays the user's edits since the buffer was last remembered into the
+        current snippet and checks if the cursor left it.
+        """
+        # Nothing to do for pure movements, the buffer is still the one that
+        # was remembered.
+        changed = self._csnippets and self._vstate.buffer_changed
+        if changed:
             cstart = self._csnippets[0].start.line
             cend = self._csnippets[0].end.line + self._vstate.diff_in_buffer_length
             ct = _vim.buf[cstart:cend + 1]
+            read = (cstart, ct, len(_vim.buf))
             lt = self._vstate.remembered_buffer
             pos = _vim.buf.cursor
 
@@ -666,24 +921,62 @@ class SnippetManager(object):
             lt_span[0] = max(0, lt_span[0] - 1)
             initial_line = max(cstart, initial_line - 1)
 
-            lt = lt[lt_span[0]:lt_span[1]]
+            lt = list(lt[lt_span[0]:lt_span[1]])
             ct = ct[ct_span[0]:ct_span[1]]
 
             try:
                 rv, es = guess_edit(initial_line, lt, ct, self._vstate)
                 if not rv:
-                    lt = '\n'.join(lt)
-                    ct = '\n'.join(ct)
-                    es = diff(lt, ct, initial_line)
+                    es = line_diff(lt, ct, initial_line, self._diff_engine(),
+                            self._diff_budget())
                 self._csnippets[0].replay_user_edits(es)
             except IndexError:
-                pass # Rather do nothing than throwing an error. It will be correct most of the time
+                # Rather do nothing than throwing an error. It will be correct
+                # most of the time, but the text we wrote can not be trusted.
+                self._csnippets[0].forget_written_text()
+            else:
+                # Lines were added or removed outside of the lines we diffed
+                new_lines = 0
+                for ctype, line, col, text in es:
+                    n = text.count("\n")
+                    new_lines += n if ctype == "I" else -n
+                if new_lines != self._vstate.diff_in_buffer_length:
+                    self._csnippets[0].forget_written_text()
 
         self._check_if_still_inside_snippet()
-        if self._csnippets:
-            self._csnippets[0].update_textobjects()
-            self._vstate.remember_buffer(self._csnippets[0])
+        if changed and self._csnippets:
+            _vim.buf.record_writes()
+            try:
+                self._csnippets[0].update_textobjects()
+            finally:
+                writes = _vim.buf.recorded_writes()
+            self._vstate.remember_buffer(self._csnippets[0], read, writes)
+
+
+    @err_to_scratch_buffer
+    def shell_code_timer(self):
+        """
+        Called by a Vim timer while shell code runs in the background. Puts
+        the output of the finished commands into the current snippet.
+        """
+        self._shell_code_timer = False
+
+        # Wait until the user's edits have been replayed and no tabstop is
+        # selected.
+        if _vim.eval("mode()") not in 'in' or (
+                self._csnippets and self._vstate.buffer_changed):
+            self._start_shell_code_timer()
+            return
+
+        # The output of shell code that the user overwrote is dropped.
+        root = self._csnippets[0] if self._csnippets else None
+        finished = finished_shell_code(root)
+        if finished:
+            root.finish_shell_code(finished)
+            self._vstate.remember_buffer(root)
 
+        if shell_code_running():
+            self._start_shell_code_timer()
 
     def leaving_buffer(self):
         """
@@ -716,6 +1009,7 @@ class SnippetManager(object):
     def _reinit(self):
         self._ctab = None
         self._ignore_movements = False
+        self._ignore_text_change = False
 
     def _check_if_still_inside_snippet(self):
         # Did we leave the snippet with this movement?
@@ -727,7 +1021,13 @@ class SnippetManager(object):
             self._check_if_still_inside_snippet()
 
     def _current_snippet_is_done(self):
-        self._csnippets.pop()
+        snippet = self._csnippets.pop()
+        # Nobody keeps the positions in a snippet that is done up to date, so
+        # its commands that still run in the background must finish now.
+        if not self._csnippets and shell_code_running():
+            finished = finished_shell_code(snippet, wait = True)
+            if finished:
+                snippet.finish_shell_code(finished)
 
     def _jump(self, backwards = False):
         jumped = False
@@ -785,26 +1085,33 @@ class SnippetManager(object):
         possible matches.
         """
         self._ensure_all_loaded()
-        filetypes = self._filetypes[_vim.buf.nr][::-1]
+        dictionaries = [ self._snippets[ft]
+                for ft in self._filetype_chain(self._filetypes[_vim.buf.nr]) ]
 
         found_snippets = []
-        for ft in filetypes:
-            found_snippets += self._find_snippets(ft, before, possible)
-
-        # Search if any of the snippets overwrites the previous
-        # Dictionary allows O(1) access for easy overwrites
-        snippets = {}
-        for s in found_snippets:
-            if (s.trigger not in snippets) or s.overwrites_previous:
-                snippets[s.trigger] = []
-            snippets[s.trigger].append(s)
-
-        # Transform dictionary into flat list of snippets
-        selected_snippets = set([item for sublist in snippets.values() for item in sublist])
-        # Return snippets to their original order
-        snippets = [snip for snip in found_snippets if snip in selected_snippets]
+        for sd in dictionaries:
+            found_snippets += sd.get_matching_snippets(before, possible)
+
+        if possible:
+            # Every dictionary returns its snippets sorted by trigger, so this
+            # only merges the runs. It is stable and keeps the priority order
+            # of snippets with the same trigger for the overwrites below.
+            found_snippets.sort(key=lambda s: s.trigger)
+
+        if not any(sd.has_overwrites for sd in dictionaries):
+            return found_snippets
+
+        # Search if any of the snippets overwrites the previous. Only
+        # snippets from the last overwriting one on are kept for a trigger.
+        first_kept = {}
+        for idx, s in enumerate(found_snippets):
+            if s.overwrites_previous:
+                first_kept[s.trigger] = idx
+        selected_snippets = set([ s for idx, s in enumerate(found_snippets)
+            if idx >= first_kept.get(s.trigger, 0) ])
 
-        return snippets
+        # Return snippets to their original order
+        return [ s for s in found_snippets if s in selected_snippets ]
 
     def _ask_snippets(self, snippets):
         """ Given a list of snippets, ask the user which one they
@@ -849,11 +1156,23 @@ class SnippetManager(object):
         self._visual_content.reset()
         self._csnippets.append(si)
 
+        # Expanding fires both CursorMovedI and TextChangedI for the text we
+        # inserted ourselves. Neither must be taken for an edit by the user.
         self._ignore_movements = True
+        self._ignore_text_change = _vim.eval("exists('##TextChangedI')") == "1"
         self._vstate.remember_buffer(self._csnippets[0])
 
+        if shell_code_running():
+            self._start_shell_code_timer()
+
         self._jump()
 
+    def _start_shell_code_timer(self):
+        """Makes Vim call shell_code_timer soon, if it does not yet."""
+        if not self._shell_code_timer:
+            self._shell_code_timer = True
+            _vim.command("call timer_start(50, 'UltiSnips_ShellCodeTimer')")
+
     def _try_expand(self):
         before, after = _vim.buf.current_line_splitted
         if not before:
@@ -882,7 +1201,62 @@ class SnippetManager(object):
 
     def _parse_snippets(self, ft, fn, file_data=None):
         self.add_snippet_file(ft, fn)
-        _SnippetsFileParser(ft, fn, self, file_data).parse()
+
+        cache = None
+        if file_data is None:
+            cache = self._snippet_cache()
+        if cache is not None:
+            data = open(fn, "rb").read()
+            cached = cache.load(fn, data)
+            if cached is not None:
+                records, globals = cached
+                self._add_snippet_records(ft, fn, records, globals)
+                return
+
+        parser = _SnippetsFileParser(ft, fn, self, file_data)
+        records, globals = parser.parse()
+        self._add_snippet_records(ft, fn, records, globals)
+
+        if cache is not None and not parser.had_errors:
+            cache.store(fn, data, records, globals)
+
+    def _add_snippet_records(self, ft, fn, records, globals):
+        """Adds the records of a parsed snippet file, see
+        _SnippetsFileParser."""
+        for record in records:
+            head, args = record[0], record[1:]
+            if head == "extends":
+                self.add_extending_info(ft, args[0])
+            elif head == "snippet":
+                trig, value, descr, options = args
+                self.add_snippet(trig, value, descr, options, ft, globals,
+                        fn=fn)
+            elif head == "clearsnippets":
+                self.clear_snippets(args[0], ft)
+
+    def _snippet_cache(self):
+        """Returns the cache for parsed snippet files or None if it is not
+        enabled."""
+        if _vim.eval("exists('g:UltiSnipsCacheDirectory')") == "0":
+            return None
+        directory = _vim.eval("g:UltiSnipsCacheDirectory")
+        if not directory:
+            return None
+        return SnippetFileCache(directory)
+
+    @err_to_scratch_buffer
+    def purge_cache(self):
+        """Removes all parsed snippet files from the cache."""
+        cache = self._snippet_cache()
+        if cache is not None:
+            cache.purge()
+
+    @err_to_scratch_buffer
+    def rebuild_cache(self):
+        """Purges the cache and parses all loaded snippet files again."""
+        self.purge_cache()
+        for ft in list(self._snippets.keys()):
+            self._load_snippets_for(ft)
 
     def base_snippet_files_for(self, ft, default=True):
         """ Returns a list of snippet files matching the given filetype (ft).
@@ -895,30 +1269,79 @@ class SnippetManager(object):
         the filetype.
         """
 
-        snippet_dirs = _vim.eval("g:UltiSnipsSnippetDirectories")
         base_snippets = os.path.realpath(os.path.join(__file__, "../../../UltiSnips"))
         ret = []
 
-        paths = _vim.eval("&runtimepath").split(',')
+        for pth in self._snippet_directories():
+            names = self._list_directory(pth)
+            patterns = ["%s.snippets", "%s_*.snippets"]
+            if not default and pth == base_snippets:
+                patterns.remove("%s.snippets")
+
+            found = []
+            for pattern in patterns:
+                found += [ os.path.join(pth, n)
+                        for n in fnmatch.filter(names, pattern % ft) ]
+            if ft in names:
+                sub = os.path.join(pth, ft)
+                found += [ os.path.join(sub, n)
+                        for n in self._list_directory(sub) ]
+
+            for fn in found:
+                if fn not in ret:
+                    ret.append(fn)
 
-        if _vim.eval("exists('g:UltiSnipsDontReverseSearchPath')") == "0" or \
-           _vim.eval("g:UltiSnipsDontReverseSearchPath") == "0":
+        return ret
+
+    def _snippet_directories(self):
+        """ Returns the snippet directories in the order they are searched.
+        These are the directories named in 'g:UltiSnipsSnippetDirectories'
+        inside of each path in 'runtimepath'. The result is cached until one of
+        these options changes.
+        """
+        key = _vim.eval("[&runtimepath, g:UltiSnipsSnippetDirectories, "
+                "get(g:, 'UltiSnipsDontReverseSearchPath', '0')]")
+        key = (key[0], tuple(key[1]), key[2])
+        if self._snippet_dirs_cache[0] == key:
+            return self._snippet_dirs_cache[1]
+
+        rtp_option, snippet_dirs, dont_reverse = key
+        paths = rtp_option.split(',')
+        if dont_reverse == "0":
             paths = paths[::-1]
 
+        ret = []
         for rtp in paths:
             for snippet_dir in snippet_dirs:
-                pth = os.path.realpath(os.path.expanduser(os.path.join(rtp, snippet_dir)))
+                ret.append(os.path.realpath(os.path.expanduser(
+                    os.path.join(rtp, snippet_dir))))
 
-                patterns = ["%s.snippets", "%s_*.snippets", os.path.join("%s","*")]
-                if not default and pth == base_snippets:
-                    patterns.remove("%s.snippets")
+        self._snippet_dirs_cache = (key, ret)
+        return ret
 
-                for pattern in patterns:
-                    for fn in glob.glob(os.path.join(pth, pattern % ft)):
-                        if fn not in ret:
-                            ret.append(fn)
+    def _list_directory(self, path):
+        """ Returns the names of the non hidden entries in the directory at
+        path, or an empty list if it does not exist. The listing is cached
+        until the modification time of the directory changes.
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return []
 
-        return ret
+        cached = self._dir_listings.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        try:
+            names = [ n for n in os.listdir(path) if not n.startswith('.') ]
+        except OSError:
+            return []
+        # The modification time has a coarse resolution on some file systems.
+        # Do not trust it for directories that have just been changed.
+        if time.time() - mtime > 2:
+            self._dir_listings[path] = (mtime, names)
+        return names
 
     @property
     def primary_filetype(self):
@@ -967,10 +1390,18 @@ class SnippetManager(object):
     # Loading
     def _load_snippets_for(self, ft):
         self.snippet_dict(ft).reset()
+        self._filetype_chains.clear()
+        forget_global_namespaces()
 
         for fn in self.base_snippet_files_for(ft):
             self._parse_snippets(ft, fn)
 
+        watcher = self._snippet_watcher()
+        if watcher is not None:
+            directories = self._snippet_directories()
+            watcher.watch(ft, directories)
+            self._watched_dirs[ft] = directories
+
         # Now load for the parents
         for p in self._snippets[ft].extends:
             if p not in self._snippets:
@@ -983,9 +1414,25 @@ class SnippetManager(object):
 
         if ft not in self._snippets:
             return True
-        elif do_hash and self.snippet_dict(ft).needs_update():
+        elif not do_hash:
+            return False
+
+        watcher = self._snippet_watcher()
+        if watcher is not None:
+            # 'runtimepath' or g:UltiSnipsSnippetDirectories might have changed
+            if self._watched_dirs.get(ft) != self._snippet_directories():
+                return True
+            return watcher.has_changed(ft)
+
+        # Do not look at the files more often than the user wants
+        now = time.time()
+        if now - self._last_update_check.get(ft, 0) < self._check_interval():
+            return False
+        self._last_update_check[ft] = now
+
+        if self.snippet_dict(ft).needs_update():
             return True
-        elif do_hash:
+        else:
             cur_snips = set(self.base_snippet_files_for(ft))
             old_snips = set(self.snippet_dict(ft).files)
 
@@ -995,6 +1442,36 @@ class SnippetManager(object):
         return False
 
 
+    def _snippet_watcher(self):
+        """Returns the watcher for the snippet directories or None if
+        watching is not enabled."""
+        if _vim.eval('exists("g:UltiSnipsWatchSnippetFiles")') == "0" or \
+                _vim.eval("g:UltiSnipsWatchSnippetFiles") == "0":
+            return None
+        if self._watcher is None:
+            self._watcher = create_watcher(self._check_interval() or 1)
+        return self._watcher
+
+    def _diff_engine(self):
+        """The algorithm used to find out what the user changed."""
+        if _vim.eval('exists("g:UltiSnipsDiffEngine")') == "0":
+            return "auto"
+        return _vim.eval("g:UltiSnipsDiffEngine")
+
+    def _diff_budget(self):
+        """The number of steps the diff may take before it gives up and
+        replaces everything that changed. None means no limit."""
+        if _vim.eval('exists("g:UltiSnipsDiffBudget")') == "0":
+            return 200000
+        return int(_vim.eval("g:UltiSnipsDiffBudget")) or None
+
+    def _check_interval(self):
+        """The minimum number of seconds between two checks for changed
+        snippet files."""
+        if _vim.eval('exists("g:UltiSnipsCheckInterval")') == "0":
+            return 0
+        return float(_vim.eval("g:UltiSnipsCheckInterval"))
+
     def _ensure_loaded(self, ft, checked=None):
         if not checked:
             checked = set([ft])
@@ -1035,34 +1512,38 @@ class SnippetManager(object):
 
         self._ensure_all_loaded()
 
-    def _find_snippets(self, ft, trigger, potentially = False, seen=None):
+    def _filetype_chain(self, filetypes):
         """
-        Find snippets matching trigger
-
-        ft          - file type to search
-        trigger     - trigger to match against
-        potentially - also returns snippets that could potentially match; that
-                      is which triggers start with the current trigger
+        Returns the filetypes whose snippets are searched for a buffer with
+        the given filetypes, in order of increasing priority. The result is
+        cached until the extends information or the snippets change.
+        """
+        key = tuple(filetypes)
+        if key not in self._filetype_chains:
+            chain = []
+            for ft in filetypes[::-1]:
+                chain += self._resolve_extends(ft, [])
+            self._filetype_chains[key] = chain
+        return self._filetype_chains[key]
+
+    def _resolve_extends(self, ft, seen):
+        """
+        Returns ft preceded by all the filetypes it extends (recursively) that
+        are not yet in seen.
         """
         snips = self._snippets.get(ft,None)
         if not snips:
             return []
 
-        if not seen:
-            seen = []
         seen.append(ft)
 
-        parent_results = []
-
+        parents = []
         for p in snips.extends:
             if p not in seen:
                 seen.append(p)
-                parent_results += self._find_snippets(p, trigger,
-                        potentially, seen)
-
-        return parent_results + snips.get_matching_snippets(
-            trigger, potentially)
+                parents += self._resolve_extends(p, seen)
 
+        return parents + [ft]
 
 UltiSnips_Manager = SnippetManager()
 
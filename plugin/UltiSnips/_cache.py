@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A cache of parsed snippet files on disk. For every snippet file, the records
+produced by parsing it are stored together with the size, modification time
+and hash of the file, so that an unchanged file must not be parsed again.
+"""
+
+import glob
+import hashlib
+import json
+import os
+
+__all__ = [ "SnippetFileCache" ]
+
+# Increase this whenever the format of the records changes.
+_FORMAT_VERSION = 1
+
+def file_hash(data):
+    """Returns the hash used to identify the content of a file."""
+    return hashlib.sha1(data).hexdigest()
+
+class SnippetFileCache(object):
+    """
+    Stores the records of parsed snippet files as json files inside a
+    directory. Failing to read or write the cache is never an error, the
+    snippet file is then simply parsed again.
+    """
+    def __init__(self, directory):
+        self._dir = os.path.expanduser(directory)
+
+    @property
+    def directory(self):
+        return self._dir
+
+    def _cache_file(self, path):
+        name = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+        return os.path.join(self._dir, name + ".json")
+
+    def _key(self, path, data):
+        st = os.stat(path)
+        return {
+            "version": _FORMAT_VERSION,
+            "path": os.path.abspath(path),
+            "mtime": st.st_mtime,
+            "size": st.st_size,
+            "hash": file_hash(data),
+        }
+
+    def load(self, path, data):
+        """
+        Returns the (records, globals) stored for the snippet file at path
+        whose content is data, or None if there is no valid entry.
+        """
+        try:
+            key = self._key(path, data)
+            f = open(self._cache_file(path), "r")
+            try:
+                entry = json.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return None
+
+        for k, v in key.items():
+            if entry.get(k) != v:
+                return None
+        return entry["records"], entry["globals"]
+
+    def store(self, path, data, records, globals):
+        """Stores the records and globals parsed from the snippet file at
+        path whose content is data."""
+        try:
+            entry = self._key(path, data)
+            entry["records"] = records
+            entry["globals"] = globals
+
+            if not os.path.isdir(self._dir):
+                os.makedirs(self._dir)
+
+            fn = self._cache_file(path)
+            tmp = fn + ".tmp"
+            f = open(tmp, "w")
+            try:
+                json.dump(entry, f)
+            finally:
+                f.close()
+            if os.path.exists(fn): # os.rename does not replace on Windows
+                os.unlink(fn)
+            os.rename(tmp, fn)
+        except (IOError, OSError):
+            pass
+
+    def purge(self):
+        """Removes all entries from the cache."""
+        for fn in glob.glob(os.path.join(self._dir, "*.json")):
+            try:
+                os.unlink(fn)
+            except OSError:
+                pass
@@ -8,23 +8,54 @@ from UltiSnips import _vim
 from UltiSnips.geometry import Position
 
 def is_complete_edit(initial_line, a, b, cmds):
-    buf = a[:]
-    for cmd in cmds:
-        ctype, line, col, char = cmd
-        line -= initial_line
+    """
+    Returns True if applying cmds to the lines a gives the lines b. Only the
+    lines touched by the commands are copied and edited, the rest of a is
+    compared to b as it is.
+    """
+    if not cmds:
+        return a == b
+    lo = min(cmd[1] for cmd in cmds) - initial_line
+    if lo < 0:
+        return False
+
+    # window replaces the lines a[lo:end]
+    window, end = [], lo
+    for ctype, line, col, char in cmds:
+        idx = line - initial_line - lo
+        while len(window) <= idx + 1 and end < len(a):
+            window.append(a[end])
+            end += 1
+        if idx >= len(window):
+            return False
         if ctype == "D":
             if char != '\n':
-                buf[line] = buf[line][:col] + buf[line][col+len(char):]
+                window[idx] = window[idx][:col] + window[idx][col+len(char):]
+            elif idx + 1 < len(window):
+                window[idx:idx+2] = [ window[idx] + window[idx+1] ]
             else:
-                if line + 1 < len(buf):
-                    buf[line] = buf[line] + buf[line+1]
-                    del buf[line+1]
-                else:
-                    del buf[line]
+                del window[idx]
         elif ctype == "I":
-            buf[line] = buf[line][:col] + char + buf[line][col:]
-        buf = '\n'.join(buf).split('\n')
-    return len(buf) == len(b) and all(j==k for j,k in zip(buf, b))
+            text = window[idx][:col] + char + window[idx][col:]
+            window[idx:idx+1] = text.split('\n')
+
+    return (len(b) == len(a) - (end - lo) + len(window) and
+            b[lo:lo + len(window)] == window and
+            b[:lo] == a[:lo] and b[lo + len(window):] == a[end:])
+
+def apply_writes(first, lines, writes):
+    """
+    Returns a copy of lines, the buffer lines starting at line first, with
+    writes applied in order. writes is a list of (start, end, new_lines)
+    tuples as returned by VimBuffer.recorded_writes. Returns None if a write
+    touches lines outside of lines.
+    """
+    lines = list(lines)
+    for i, j, new_lines in writes:
+        if i < first or j - first > len(lines):
+            return None
+        lines[i - first:j - first] = new_lines
+    return lines
 
 def guess_edit(initial_line, lt, ct, vs):
     """
@@ -87,7 +118,114 @@ def guess_edit(initial_line, lt, ct, vs):
             if is_complete_edit(initial_line, lt, ct, es): return True, es
     return False, None
 
-def diff(a, b, sline = 0):
+# Above this many characters in both texts, "auto" uses the Myers engine
+AUTO_MYERS_THRESHOLD = 200
+
+# Visiting a node in dijkstra_diff costs about as much time as searching this
+# many diagonals in myers_diff
+DIJKSTRA_STEP_COST = 16
+
+class _BudgetExhausted(Exception):
+    pass
+
+class _Budget(object):
+    """
+    The number of steps a diff may take. Both engines spend steps while they
+    search and give up by raising _BudgetExhausted when there are none left.
+    """
+    def __init__(self, steps):
+        self.steps = steps
+
+    def spend(self, steps):
+        if self.steps is None:
+            return
+        self.steps -= steps
+        if self.steps < 0:
+            raise _BudgetExhausted()
+
+def coarse_diff(a, b, sline = 0):
+    """
+    Return the simplest list of deletions and insertions that will turn a
+    into b: everything between the common beginning and end of both is
+    deleted and inserted again. This is not the cheapest edit, but it is
+    found in linear time.
+    """
+    prefix = 0
+    while prefix < min(len(a), len(b)) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(len(a), len(b)) - prefix and \
+            a[-suffix - 1] == b[-suffix - 1]:
+        suffix += 1
+    return _commands([
+        ["", "", a[:prefix]],
+        [a[prefix:len(a) - suffix], b[prefix:len(b) - suffix], ""],
+    ], sline)
+
+def diff(a, b, sline = 0, engine = "auto", budget = None):
+    """
+    Return a list of deletions and insertions that will turn a into b. The
+    commands are ("D"/"I", line, col, text) and are meant to be applied in
+    order; text is either a single newline or contains none.
+
+    engine selects the algorithm: "dijkstra" finds the cheapest script
+    according to the costs described in dijkstra_diff, but its runtime grows
+    with the product of the text sizes. "myers" is linear in space and fast
+    for small differences, see myers_diff. "auto" uses dijkstra for small
+    texts and myers above AUTO_MYERS_THRESHOLD characters.
+
+    budget is the maximum number of steps the engine may take, None means no
+    limit. If it is used up, the result of coarse_diff is returned instead.
+    """
+    if not isinstance(budget, _Budget):
+        budget = _Budget(budget)
+    if engine == "auto":
+        if len(a) + len(b) > AUTO_MYERS_THRESHOLD:
+            engine = "myers"
+        else:
+            engine = "dijkstra"
+    try:
+        if engine == "myers":
+            return myers_diff(a, b, sline, budget)
+        return dijkstra_diff(a, b, sline, budget)
+    except _BudgetExhausted:
+        return coarse_diff(a, b, sline)
+
+def line_diff(a, b, sline = 0, engine = "auto", budget = None):
+    """
+    Like diff, but a and b are lists of lines. Unchanged lines are matched
+    first, then only the changed hunks are diffed character by character. This
+    keeps the work small when only a few lines of a long text changed. The
+    budget is shared between all hunks.
+    """
+    budget = _Budget(budget)
+    # Every line but the last keeps its newline, so that a hunk always starts
+    # at the beginning of a line and can be diffed on its own.
+    a = [ l + '\n' for l in a[:-1] ] + a[-1:]
+    b = [ l + '\n' for l in b[:-1] ] + b[-1:]
+
+    ids = {}
+    a_ids = [ ids.setdefault(l, len(ids)) for l in a ]
+    b_ids = [ ids.setdefault(l, len(ids)) for l in b ]
+
+    try:
+        hunks = _hunks(_myers_ops(a_ids, b_ids, budget), list)
+    except _BudgetExhausted:
+        return coarse_diff(''.join(a), ''.join(b), sline)
+
+    rv = []
+    line, x, y = sline, 0, 0
+    for deleted, inserted, equal in hunks:
+        old = ''.join(a[x:x + len(deleted)])
+        new = ''.join(b[y:y + len(inserted)])
+        if old or new:
+            rv.extend(diff(old, new, line, engine, budget))
+        line += len(inserted) + len(equal)
+        x += len(deleted) + len(equal)
+        y += len(inserted) + len(equal)
+    return tuple(rv)
+
+def dijkstra_diff(a, b, sline = 0, budget = None):
     """
     Return a list of deletions and insertions that will turn a into b. This is
     done by traversing an implicit edit graph and searching for the shortest
@@ -104,7 +242,10 @@ def diff(a, b, sline = 0):
         "D" w , "D" rld, "I" a, "I" lsa
     [2] This is that "hello\n\n" -> "hello\n\n\n" will insert a newline after hello
         and not after \n
+
+    Every visited node costs DIJKSTRA_STEP_COST steps of the budget, see diff.
     """
+    budget = budget or _Budget(None)
     d = defaultdict(list)
     seen = defaultdict(lambda: sys.maxsize)
 
@@ -116,6 +257,7 @@ def diff(a, b, sline = 0):
     while True:
         while len(d[cost]):
             x, y, line, col, what = d[cost].pop()
+            budget.spend(DIJKSTRA_STEP_COST)
 
             if a[x:] == b[y:]:
                 return what
@@ -131,7 +273,7 @@ def diff(a, b, sline = 0):
                         what[-1][2] == col and a[x] != '\n'):
                     # Matching directly after a deletion should be as costly as
                     # DELETE + INSERT + a bit
-                    lcost = (D_COST + I_COST)*1.5
+                    lcost = cost + (D_COST + I_COST) * 3 // 2
                 if seen[x+1,y+1] > lcost:
                     d[lcost].append((x+1,y+1, nline, ncol, what))
                     seen[x+1,y+1] = lcost
@@ -170,5 +312,218 @@ def diff(a, b, sline = 0):
                     d[cost + D_COST].append((x+1,y, line, col, what +
                         (("D",line, col, a[x]),) )
                     )
-        cost += 1
+        # Go on with the cheapest bucket that is left. The end can always be
+        # reached, but rather give up than search forever.
+        del d[cost]
+        if not d:
+            raise _BudgetExhausted()
+        cost = min(d)
+
+
+# Myers Diff  {{{
+def _bisect(a, b, budget):
+    """
+    Finds the middle snake of the shortest edit script between a and b as
+    described by Myers in "An O(ND) Difference Algorithm and Its Variations"
+    and splits the problem there. Uses only linear space.
+    """
+    n, m = len(a), len(b)
+    max_d = (n + m + 1) // 2
+    v_offset = max_d
+    v_length = 2 * max_d + 2
+    v1 = [-1] * v_length
+    v1[v_offset + 1] = 0
+    v2 = [-1] * v_length
+    v2[v_offset + 1] = 0
+    delta = n - m
+    # If the total number of characters is odd, the front path will collide
+    # with the reverse path.
+    front = (delta % 2 != 0)
+    # Offsets for start and end of k loop. Prevents mapping of space beyond
+    # the grid.
+    k1start = k1end = k2start = k2end = 0
+    for d in range(max_d):
+        budget.spend(2 * d + 2)
+        # Walk the front path one step.
+        for k1 in range(-d + k1start, d + 1 - k1end, 2):
+            k1_offset = v_offset + k1
+            if k1 == -d or (k1 != d and v1[k1_offset - 1] < v1[k1_offset + 1]):
+                x1 = v1[k1_offset + 1]
+            else:
+                x1 = v1[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[x1] == b[y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_offset] = x1
+            if x1 > n:
+                k1end += 2 # Ran off the right of the graph.
+            elif y1 > m:
+                k1start += 2 # Ran off the bottom of the graph.
+            elif front:
+                k2_offset = v_offset + delta - k1
+                if 0 <= k2_offset < v_length and v2[k2_offset] != -1:
+                    # Mirror x2 onto top-left coordinate system.
+                    if x1 >= n - v2[k2_offset]:
+                        return _myers_ops(a[:x1], b[:y1], budget) + \
+                                _myers_ops(a[x1:], b[y1:], budget)
+
+        # Walk the reverse path one step.
+        for k2 in range(-d + k2start, d + 1 - k2end, 2):
+            k2_offset = v_offset + k2
+            if k2 == -d or (k2 != d and v2[k2_offset - 1] < v2[k2_offset + 1]):
+                x2 = v2[k2_offset + 1]
+            else:
+                x2 = v2[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and a[n - x2 - 1] == b[m - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            v2[k2_offset] = x2
+            if x2 > n:
+                k2end += 2 # Ran off the left of the graph.
+            elif y2 > m:
+                k2start += 2 # Ran off the top of the graph.
+            elif not front:
+                k1_offset = v_offset + delta - k2
+                if 0 <= k1_offset < v_length and v1[k1_offset] != -1:
+                    x1 = v1[k1_offset]
+                    y1 = v_offset + x1 - k1_offset
+                    # Mirror x2 onto top-left coordinate system.
+                    if x1 >= n - x2:
+                        return _myers_ops(a[:x1], b[:y1], budget) + \
+                                _myers_ops(a[x1:], b[y1:], budget)
+
+    # Number of diffs equals number of characters, no commonality at all.
+    return [ ("D", a), ("I", b) ]
+
+def _myers_ops(a, b, budget):
+    """
+    Returns a shortest edit script from a to b as a list of ("=", text),
+    ("D", text) and ("I", text) runs.
+    """
+    if a == b:
+        return [ ("=", a) ] if a else []
+
+    prefix = 0
+    while prefix < min(len(a), len(b)) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(len(a), len(b)) - prefix and \
+            a[-suffix - 1] == b[-suffix - 1]:
+        suffix += 1
+
+    rv = []
+    if prefix:
+        rv.append(("=", a[:prefix]))
+    ma, mb = a[prefix:len(a) - suffix], b[prefix:len(b) - suffix]
+    if not ma:
+        rv.append(("I", mb))
+    elif not mb:
+        rv.append(("D", ma))
+    else:
+        rv.extend(_bisect(ma, mb, budget))
+    if suffix:
+        rv.append(("=", a[len(a) - suffix:]))
+    return rv
 
+def _hunks(ops, empty = str):
+    """
+    Groups the runs into a list of [deleted, inserted, equal] hunks, where
+    equal is the text that follows the change. The first hunk might have no
+    change, only the last might have no equal text. empty creates the
+    empty sequences.
+    """
+    hunks = [ [empty(), empty(), empty()] ]
+    for op, text in ops:
+        if op == "=":
+            hunks[-1][2] += text
+        else:
+            if hunks[-1][2]:
+                hunks.append([empty(), empty(), empty()])
+            hunks[-1][op == "I"] += text
+    return hunks
+
+def _apply_cost_heuristics(hunks):
+    """
+    Changes the shortest edit script so that it looks like the ones
+    dijkstra_diff prefers:
+        - Text that is matched directly after a deletion and followed by
+          another change (without a newline in between) is deleted and
+          inserted again instead. So world -> aolsa is "D" world, "I" aolsa.
+        - Pure deletions and insertions are moved as far to the front as
+          possible, so inserting a newline after "hello\n\n" inserts it
+          directly after hello.
+    Deletions of a hunk are always done before its insertions.
+    """
+    merged = [ hunks[0] ]
+    for hunk in hunks[1:]:
+        prev = merged[-1]
+        if prev[0] and prev[2] and '\n' not in prev[2]:
+            prev[0] += prev[2] + hunk[0]
+            prev[1] += prev[2] + hunk[1]
+            prev[2] = hunk[2]
+        else:
+            merged.append(hunk)
+
+    # Slide pure insertions and deletions to the front. The equal text in
+    # front of a hunk is the equal text of the hunk before.
+    for idx in range(1, len(merged)):
+        before, hunk = merged[idx - 1], merged[idx]
+        if hunk[0] and hunk[1]:
+            continue
+        changed = hunk[0] or hunk[1]
+        shift = 0
+        while shift < len(before[2]) and shift < len(changed) and \
+                before[2][-shift - 1] == changed[-shift - 1]:
+            shift += 1
+        if shift:
+            moved = before[2][len(before[2]) - shift:]
+            changed = moved + changed[:len(changed) - shift]
+            before[2] = before[2][:len(before[2]) - shift]
+            hunk[2] = moved + hunk[2]
+            hunk[hunk[1] != ""] = changed
+    return merged
+
+def _split_lines(text):
+    """Splits text into pieces that are either a single newline or contain
+    none."""
+    rv = []
+    for piece in text.split('\n'):
+        if piece:
+            rv.append(piece)
+        rv.append('\n')
+    return rv[:-1]
+
+def myers_diff(a, b, sline = 0, budget = None):
+    """
+    Return a list of deletions and insertions that will turn a into b, like
+    dijkstra_diff. The edit script is computed with the linear space variant
+    of Myers' algorithm in O((N+D)D) time and then changed to follow the cost
+    heuristics of dijkstra_diff as far as they can be applied locally. It is
+    not always the same script, but always a valid one. Every diagonal that
+    is searched costs one step of the budget, see diff.
+    """
+    hunks = _hunks(_myers_ops(a, b, budget or _Budget(None)))
+    return _commands(_apply_cost_heuristics(hunks), sline)
+
+def _commands(hunks, sline):
+    """Turns [deleted, inserted, equal] hunks into edit commands."""
+    line, col = sline, 0
+    rv = []
+    for deleted, inserted, equal in hunks:
+        for piece in _split_lines(deleted):
+            rv.append(("D", line, col, piece))
+        for piece in _split_lines(inserted):
+            rv.append(("I", line, col, piece))
+            if piece == '\n':
+                line, col = line + 1, 0
+            else:
+                col += len(piece)
+        for piece in _split_lines(equal):
+            if piece == '\n':
+                line, col = line + 1, 0
+            else:
+                col += len(piece)
+    return tuple(rv)
+# End: Myers Diff  }}}
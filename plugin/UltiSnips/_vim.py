@@ -12,6 +12,33 @@ from UltiSnips.compatibility import col2byte, byte2col, \
         as_unicode, as_vimencoding
 
 class VimBuffer(object):
+    def __init__(self):
+        self._writes = None
+        self._untracked_writes = False
+
+    def record_writes(self):
+        """Starts recording which lines are written through this object."""
+        self._writes = []
+        self._untracked_writes = False
+
+    def note_untracked_writes(self):
+        """
+        Code that might change the buffer without going through this object
+        ran, so the recorded writes are possibly incomplete.
+        """
+        self._untracked_writes = True
+
+    def recorded_writes(self):
+        """
+        Stops recording and returns the writes since record_writes as a list
+        of (start, end, new_lines) tuples: the lines start to end were
+        replaced by new_lines. Returns None if the writes are incomplete.
+        """
+        rv, self._writes = self._writes, None
+        if self._untracked_writes:
+            return None
+        return rv
+
     def __getitem__(self, idx):
         if isinstance(idx, slice): # Py3
             return self.__getslice__(idx.start, idx.stop)
@@ -25,8 +52,12 @@ class VimBuffer(object):
         if isinstance(idx, slice): # Py3
             return self.__setslice__(idx.start, idx.stop, text)
         vim.current.buffer[idx] = as_vimencoding(text)
+        if self._writes is not None:
+            self._writes.append((idx, idx + 1, [ text ]))
     def __setslice__(self, i, j, text):
         vim.current.buffer[i:j] = [ as_vimencoding(l) for l in text ]
+        if self._writes is not None:
+            self._writes.append((i, j, list(text)))
 
     def __len__(self):
         return len(vim.current.buffer)
@@ -45,6 +76,11 @@ class VimBuffer(object):
     def nr(self):
         return int(eval("bufnr('%')"))
 
+    @property
+    def changedtick(self):
+        """Vim's counter of changes to the current buffer."""
+        return int(eval("b:changedtick"))
+
     def cursor():
         """
         The current windows cursor. Note that this is 0 based in col and 0
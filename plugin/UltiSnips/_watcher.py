@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Watches snippet directories in a background thread and remembers which
+filetypes have changed snippet files, so that expanding a snippet does not
+need to look at the file system. On Linux, inotify is used. Elsewhere the
+directories are polled.
+"""
+
+from collections import defaultdict
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+import threading
+import time
+
+__all__ = [ "create_watcher" ]
+
+class _SnippetWatcher(object):
+    """
+    Base class for the watchers. It keeps track of the directories that are
+    watched for every filetype and of the filetypes that changed. Subclasses
+    implement _add_directory, _remove_directory and _run, the body of the
+    watching thread. They call _changed whenever an entry of a watched
+    directory has changed.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fts_for_dir = defaultdict(set)
+        self._subdirs = set()
+        # Filetypes by (directory, name) of snippet directories that do not
+        # exist yet and will appear as name in directory
+        self._awaited = defaultdict(set)
+        self._watched = set()
+        self._dirty = set()
+        self._thread = None
+
+    def watch(self, ft, directories):
+        """
+        Watches the snippet files for ft in the given snippet directories.
+        This are the files ft.snippets, ft_*.snippets and everything in the
+        subdirectory ft. Directories watched before for ft are forgotten.
+        """
+        with self._lock:
+            self._dirty.discard(ft)
+            for fts in self._fts_for_dir.values():
+                fts.discard(ft)
+            for fts in self._awaited.values():
+                fts.discard(ft)
+            for d in directories:
+                self._register(d, ft)
+                sub = os.path.join(d, ft)
+                if os.path.isdir(sub):
+                    self._subdirs.add(sub)
+                    self._register(sub, ft)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def has_changed(self, ft):
+        """Returns True once after a snippet file for ft has changed."""
+        with self._lock:
+            if ft in self._dirty:
+                self._dirty.discard(ft)
+                return True
+        return False
+
+    def clear(self):
+        """Forgets about all filetypes and stops watching all directories."""
+        with self._lock:
+            for d in self._watched:
+                self._remove_directory(d)
+            self._watched.clear()
+            self._fts_for_dir.clear()
+            self._subdirs.clear()
+            self._awaited.clear()
+            self._dirty.clear()
+
+    def _register(self, directory, ft):
+        if os.path.isdir(directory):
+            self._watch_directory(directory)
+            self._fts_for_dir[directory].add(ft)
+            return
+
+        # Watch the closest existing parent for the directory to appear
+        parent, name = os.path.split(os.path.abspath(directory))
+        while not os.path.isdir(parent):
+            parent, name = os.path.split(parent)
+            if not name:
+                return
+        self._watch_directory(parent)
+        self._awaited[(parent, name)].add(ft)
+
+    def _watch_directory(self, directory):
+        if directory not in self._watched:
+            self._watched.add(directory)
+            self._add_directory(directory)
+
+    def _changed(self, directory, name):
+        """Called from the watching thread when the entry name in directory
+        was created, changed or removed."""
+        with self._lock:
+            self._dirty.update(self._awaited.get((directory, name), ()))
+            fts = self._fts_for_dir.get(directory, ())
+            if directory in self._subdirs:
+                self._dirty.update(fts)
+                return
+            for ft in fts:
+                if name == ft or name == ft + ".snippets" or (
+                        name.startswith(ft + "_") and
+                        name.endswith(".snippets")):
+                    self._dirty.add(ft)
+
+    def _all_changed(self):
+        """Called from the watching thread when changes might have been
+        missed."""
+        with self._lock:
+            for fts in self._fts_for_dir.values():
+                self._dirty.update(fts)
+            for fts in self._awaited.values():
+                self._dirty.update(fts)
+
+class _InotifyWatcher(_SnippetWatcher):
+    """Uses the inotify interface of the Linux kernel through ctypes."""
+
+    # From sys/inotify.h
+    _IN_MODIFY, _IN_ATTRIB, _IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+    _IN_MOVED_FROM, _IN_MOVED_TO = 0x40, 0x80
+    _IN_CREATE, _IN_DELETE = 0x100, 0x200
+    _IN_Q_OVERFLOW = 0x4000
+    _IN_ONLYDIR = 0x01000000
+    _MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM |
+            _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_ONLYDIR)
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, libc):
+        _SnippetWatcher.__init__(self)
+        self._libc = libc
+        self._fd = libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self._dirs = {}
+
+    def _add_directory(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd,
+                directory.encode(sys.getfilesystemencoding()), self._MASK)
+        if wd >= 0:
+            self._dirs[wd] = directory
+
+    def _remove_directory(self, directory):
+        for wd, d in list(self._dirs.items()):
+            if d == directory:
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._dirs[wd]
+
+    def _run(self):
+        while True:
+            self._handle_events(os.read(self._fd, 64 * 1024))
+
+    def _handle_events(self, data):
+        idx = 0
+        while idx < len(data):
+            wd, mask, cookie, length = self._EVENT.unpack_from(data, idx)
+            idx += self._EVENT.size
+            name = data[idx:idx + length].rstrip(b"\0")
+            idx += length
+            if mask & self._IN_Q_OVERFLOW:
+                # The kernel dropped events
+                self._all_changed()
+                continue
+            with self._lock:
+                directory = self._dirs.get(wd)
+            if directory is not None:
+                self._changed(directory,
+                        name.decode(sys.getfilesystemencoding()))
+
+class _PollingWatcher(_SnippetWatcher):
+    """Looks at the watched directories every interval seconds."""
+
+    def __init__(self, interval):
+        _SnippetWatcher.__init__(self)
+        self._interval = interval
+        self._listings = {}
+
+    def _listing(self, directory):
+        rv = {}
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return rv
+        for name in names:
+            try:
+                st = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            rv[name] = (st.st_mtime, st.st_size, st.st_ino)
+        return rv
+
+    def _add_directory(self, directory):
+        self._listings[directory] = self._listing(directory)
+
+    def _remove_directory(self, directory):
+        del self._listings[directory]
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            self._poll()
+
+    def _poll(self):
+        """Looks for changes in all watched directories once."""
+        with self._lock:
+            directories = list(self._listings.keys())
+        for directory in directories:
+            new = self._listing(directory)
+            with self._lock:
+                old = self._listings.get(directory)
+                if old is None:
+                    continue # No longer watched
+                self._listings[directory] = new
+            for name in set(old) | set(new):
+                if old.get(name) != new.get(name):
+                    self._changed(directory, name)
+
+def create_watcher(poll_interval):
+    """
+    Returns an inotify based watcher if this is supported by the system,
+    otherwise one that polls every poll_interval seconds.
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                    use_errno=True)
+            return _InotifyWatcher(libc)
+        except (OSError, AttributeError):
+            pass
+    return _PollingWatcher(poll_interval)
@@ -5,7 +5,8 @@ import unittest
 
 import os.path as p, sys; sys.path.append(p.join(p.dirname(__file__), ".."))
 
-from _diff import diff, guess_edit
+from _diff import apply_writes, diff, dijkstra_diff, guess_edit, \
+        is_complete_edit, myers_diff, line_diff, coarse_diff, _Budget
 from geometry import Position
 
 
@@ -72,6 +73,38 @@ class TestGuessing_DeleteOneChar(_BaseGuessing, unittest.TestCase):
 
 # End: Test Guessing  }}}
 
+# Test Complete Edit  {{{
+class _CompleteEditBase(object):
+    initial_line = 0
+    def runTest(self):
+        self.assertEqual(self.wanted, is_complete_edit(self.initial_line,
+            self.a.split("\n"), self.b.split("\n"), self.cmds))
+
+class CompleteEdit_InsertChar(_CompleteEditBase, unittest.TestCase):
+    a, b = "one\ntwo\nthree", "one\ntwXo\nthree"
+    initial_line = 3
+    cmds = (("I", 4, 2, "X"),)
+    wanted = True
+
+class CompleteEdit_OtherLineChanged(_CompleteEditBase, unittest.TestCase):
+    a, b = "one\ntwo\nthree", "one\ntwXo\nthrée"
+    cmds = (("I", 1, 2, "X"),)
+    wanted = False
+
+class CompleteEdit_JoinAndSplitLines(_CompleteEditBase, unittest.TestCase):
+    a, b = "one\ntwo\nthree", "one\nt\nwothree"
+    cmds = (
+        ("D", 1, 3, "\n"),
+        ("I", 1, 1, "\n"),
+    )
+    wanted = True
+
+class CompleteEdit_DeleteLastNewline(_CompleteEditBase, unittest.TestCase):
+    a, b = "one\n", "one"
+    cmds = (("D", 0, 3, "\n"),)
+    wanted = True
+# End: Test Complete Edit  }}}
+
 class _Base(object):
     def runTest(self):
         es = diff(self.a, self.b)
@@ -179,6 +212,125 @@ class MultiLine(_Base, unittest.TestCase):
         ("I", 1, 12, "k"),
     )
 
+# Test Myers  {{{
+class _MyersBase(object):
+    def runTest(self):
+        es = myers_diff(self.a, self.b)
+        tr = transform(self.a, es)
+        self.assertEqual(self.b, tr)
+        self.assertEqual(self.wanted, es)
+
+class Myers_TestEmptyString(_MyersBase, TestEmptyString): pass
+class Myers_TestLotsaNewlines(_MyersBase, TestLotsaNewlines): pass
+class Myers_TestCrash(_MyersBase, TestCrash): pass
+class Myers_TestRealLife1(_MyersBase, TestRealLife1): pass
+class Myers_TestWithNewline(_MyersBase, TestWithNewline): pass
+class Myers_TestCheapDelete(_MyersBase, TestCheapDelete): pass
+class Myers_TestUltiSnipsProblem(_MyersBase, TestUltiSnipsProblem): pass
+class Myers_MultiLine(_MyersBase, MultiLine): pass
+
+class LongTextUsesMyers(_Base, unittest.TestCase):
+    a = '\n'.join("line %i of a long snippet" % i for i in range(100))
+    b = a.replace("line 50 of", "line fifty of")
+    wanted = (
+        ("D", 50, 5, "50"),
+        ("I", 50, 5, "fifty"),
+    )
+# End: Test Myers  }}}
+
+# Test Line Diff  {{{
+class _LineDiffBase(object):
+    def runTest(self):
+        es = line_diff(self.a.split("\n"), self.b.split("\n"), 0)
+        tr = transform(self.a, es)
+        self.assertEqual(self.b, tr)
+        self.assertEqual(self.wanted, es)
+
+class LineDiff_MultiLine(_LineDiffBase, MultiLine): pass
+class LineDiff_TestWithNewline(_LineDiffBase, TestWithNewline): pass
+class LineDiff_TestLotsaNewlines(_LineDiffBase, TestLotsaNewlines): pass
+
+class LineDiff_OnlyChangedLines(_LineDiffBase, unittest.TestCase):
+    a = "first\nsecond\nthird\nfourth"
+    b = "first\nsecnd\nthird\nfourth\nfifth"
+    wanted = (
+        ("D", 1, 3, "o"),
+        ("I", 3, 6, "\n"),
+        ("I", 4, 0, "fifth"),
+    )
+# End: Test Line Diff  }}}
+
+# Test Budget  {{{
+class _BudgetBase(object):
+    budget = 0
+    def runTest(self):
+        for engine in ("dijkstra", "myers"):
+            es = diff(self.a, self.b, 0, engine, self.budget)
+            tr = transform(self.a, es)
+            self.assertEqual(self.b, tr)
+            self.assertEqual(self.wanted, es)
+
+class Budget_FallsBackToCoarseDiff(_BudgetBase, unittest.TestCase):
+    a = "first line\nsecond line"
+    b = "first row\nsecond row"
+    wanted = (
+        ("D", 0, 6, "line"),
+        ("D", 0, 6, "\n"),
+        ("D", 0, 6, "second line"),
+        ("I", 0, 6, "row"),
+        ("I", 0, 9, "\n"),
+        ("I", 1, 0, "second row"),
+    )
+
+class Budget_LargeEnough(_BudgetBase, unittest.TestCase):
+    a, b = "Vorne hallo Hinten", "Vorne Hinten"
+    budget = 100000
+    wanted = (
+        ("D", 0, 5, " hallo"),
+    )
+
+class Budget_MatchAfterDeletionEnds(unittest.TestCase):
+    # Matching after a deletion used to be queued at a cost that was already
+    # passed, so the search never ended
+    a, b = " \nc ", " ba c"
+    def runTest(self):
+        for budget in (None, 200000):
+            es = dijkstra_diff(self.a, self.b, 0, _Budget(budget))
+            self.assertEqual(self.b, transform(self.a, es))
+            es = diff(self.a, self.b, 0, "auto", budget)
+            self.assertEqual(self.b, transform(self.a, es))
+            es = line_diff(self.a.split("\n"), self.b.split("\n"), 0,
+                    "auto", budget)
+            self.assertEqual(self.b, transform(self.a, es))
+
+class CoarseDiff_SameText(unittest.TestCase):
+    def runTest(self):
+        self.assertEqual((), coarse_diff("abc\ndef", "abc\ndef"))
+# End: Test Budget  }}}
+
+# Test Apply Writes  {{{
+class _ApplyWritesBase(object):
+    first = 1
+    def runTest(self):
+        buf = [ "l%i" % i for i in range(10) ]
+        lines = buf[self.first:]
+        for i, j, new_lines in self.writes:
+            buf[i:j] = new_lines
+        self.assertEqual(buf[self.first:],
+                apply_writes(self.first, lines, self.writes))
+
+class ApplyWrites_Ascending(_ApplyWritesBase, unittest.TestCase):
+    writes = ( (2, 3, ["W1"]), (5, 6, ["W2"]) )
+class ApplyWrites_LaterWriteAddsLineAbove(_ApplyWritesBase, unittest.TestCase):
+    writes = ( (5, 6, ["W1"]), (2, 3, ["W2", "W3"]) )
+class ApplyWrites_LaterWriteRemovesLinesAbove(_ApplyWritesBase, unittest.TestCase):
+    writes = ( (6, 7, ["W1"]), (1, 4, ["W2"]), (3, 4, ["W3", "W4", "W5"]) )
+
+class ApplyWrites_OutsideOfLines(unittest.TestCase):
+    def runTest(self):
+        self.assertEqual(None, apply_writes(2, ["a", "b"], [ (1, 2, ["x"]) ]))
+        self.assertEqual(None, apply_writes(2, ["a", "b"], [ (3, 5, ["x"]) ]))
+# End: Test Apply Writes  }}}
 
 if __name__ == '__main__':
    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import unittest
+import os.path as p, sys; sys.path.append(p.join(p.dirname(__file__), "..", ".."))
+
+from UltiSnips.text_objects._lexer import tokenize, compile_tokens, \
+        rebase_tokens, TabStopToken
+from UltiSnips.geometry import Position
+
+# The attributes of the tokens that are compared, if the token has them
+_ATTRIBUTES = ("no", "initial_text", "code", "search", "replace", "options")
+
+def _describe(t):
+    """The type, start, end and attributes of the token t. This does not use
+    repr, which gives u'' strings for the text in Python 2."""
+    return (type(t).__name__, (t.start.line, t.start.col),
+            (t.end.line, t.end.col)) + tuple(
+                    getattr(t, name) for name in _ATTRIBUTES
+                    if hasattr(t, name))
+
+def _flatten(tokens, child_tokens):
+    rv = []
+    for t in tokens:
+        rv.append(_describe(t))
+        if isinstance(t, TabStopToken):
+            rv.extend(child_tokens(t))
+    return rv
+
+class _TokenizeBase(object):
+    offset = (0, 0)
+
+    def runTest(self):
+        tokens = tokenize(self.text, "", Position(*self.offset))
+        self.assertEqual(self.wanted, [ _describe(t) for t in tokens ])
+
+class Tokenize_PlainText(_TokenizeBase, unittest.TestCase):
+    text = "hello\nworld"
+    wanted = [ ("EndOfTextToken", (1,5), (1,5), "") ]
+
+class Tokenize_TabStopAfterText(_TokenizeBase, unittest.TestCase):
+    text = "hello\nwor${1:ld}!"
+    offset = (2, 4)
+    wanted = [
+        ("TabStopToken", (3,3), (3,10), 1, "ld"),
+        ("EndOfTextToken", (3,11), (3,11), ""),
+    ]
+
+class Tokenize_EscapesAndMirrors(_TokenizeBase, unittest.TestCase):
+    text = "a \\$1 $1 \\\\ ${2:x\\}y}\n`!v g:a` $"
+    wanted = [
+        ("EscapeCharToken", (0,2), (0,4), "$"),
+        ("MirrorToken", (0,6), (0,8), 1, ""),
+        ("EscapeCharToken", (0,9), (0,11), "\\"),
+        ("TabStopToken", (0,12), (0,21), 2, "x\\}y"),
+        ("VimLCodeToken", (1,0), (1,8), "", "g:a"),
+        ("EndOfTextToken", (1,10), (1,10), ""),
+    ]
+
+class Tokenize_Code(_TokenizeBase, unittest.TestCase):
+    text = "`!p snip.rv = 1`${1/a/b/g}`echo \\`hi\\``"
+    wanted = [
+        ("PythonCodeToken", (0,0), (0,16), "", "snip.rv = 1"),
+        ("TransformationToken", (0,16), (0,26), 1, "", "a", "b", "g"),
+        ("ShellCodeToken", (0,26), (0,39), "", "echo \\`hi\\`"),
+        ("EndOfTextToken", (0,39), (0,39), ""),
+    ]
+
+class CompiledTokens_SameAsTokenize(unittest.TestCase):
+    text = "for ${1:i} in ${2:range(${3:10})}:\n\t${4:pass $1}\n$0"
+
+    def _tokenize(self, text, offset):
+        return _flatten(tokenize(text, "", offset),
+                lambda t: self._tokenize(t.initial_text, t.start))
+
+    def _rebase(self, tokens, offset):
+        return _flatten(rebase_tokens(tokens, offset),
+                lambda t: self._rebase(t.child_tokens, t.start))
+
+    def runTest(self):
+        compiled = compile_tokens(self.text, "")
+        for offset in ((0, 0), (0, 7), (3, 2)):
+            offset = Position(*offset)
+            self.assertEqual(self._tokenize(self.text, offset),
+                    self._rebase(compiled, offset))
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import unittest
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+import os.path as p; sys.path.append(p.join(p.dirname(__file__), ".."))
+
+from _watcher import create_watcher, _PollingWatcher, _InotifyWatcher
+
+def _write(path, text):
+    f = open(path, "w")
+    try:
+        f.write(text)
+    finally:
+        f.close()
+
+class _PollingBase(object):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # The thread never gets to poll, the tests call _poll themselves
+        self.watcher = _PollingWatcher(3600)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, *parts):
+        return os.path.join(self.dir, *parts)
+
+    def watch(self, ft, *directories):
+        self.watcher.watch(ft, [ self.path(d) for d in directories ])
+
+class Polling_ChangedFile(_PollingBase, unittest.TestCase):
+    def runTest(self):
+        _write(self.path("python.snippets"), "a")
+        self.watch("python", "")
+        self.watch("c", "")
+        _write(self.path("python.snippets"), "abc")
+        self.watcher._poll()
+        self.assertTrue(self.watcher.has_changed("python"))
+        self.assertFalse(self.watcher.has_changed("python"))
+        self.assertFalse(self.watcher.has_changed("c"))
+
+class Polling_OtherFileIsIgnored(_PollingBase, unittest.TestCase):
+    def runTest(self):
+        self.watch("python", "")
+        _write(self.path("pythonic.snippets"), "a")
+        _write(self.path("python_django.txt"), "a")
+        self.watcher._poll()
+        self.assertFalse(self.watcher.has_changed("python"))
+
+class Polling_FileInSubdirectory(_PollingBase, unittest.TestCase):
+    def runTest(self):
+        os.mkdir(self.path("python"))
+        self.watch("python", "")
+        _write(self.path("python", "django.snippets"), "a")
+        self.watcher._poll()
+        self.assertTrue(self.watcher.has_changed("python"))
+
+class Polling_DirectoryCreatedLater(_PollingBase, unittest.TestCase):
+    def runTest(self):
+        self.watch("python", os.path.join("a", "UltiSnips"))
+        os.mkdir(self.path("a"))
+        self.watcher._poll()
+        self.assertTrue(self.watcher.has_changed("python"))
+
+        # After reloading, the new directory itself is watched
+        os.mkdir(self.path("a", "UltiSnips"))
+        self.watch("python", os.path.join("a", "UltiSnips"))
+        _write(self.path("a", "UltiSnips", "python.snippets"), "a")
+        self.watcher._poll()
+        self.assertTrue(self.watcher.has_changed("python"))
+
+class Polling_ClearStopsWatching(_PollingBase, unittest.TestCase):
+    def runTest(self):
+        self.watch("python", "", "missing")
+        self.watcher.clear()
+        self.assertEqual(self.watcher._listings, {})
+        _write(self.path("python.snippets"), "a")
+        os.mkdir(self.path("missing"))
+        self.watcher._poll()
+        self.assertFalse(self.watcher.has_changed("python"))
+
+class Polling_WatchAgainForgetsOldDirectories(_PollingBase, unittest.TestCase):
+    def runTest(self):
+        os.mkdir(self.path("a"))
+        os.mkdir(self.path("b"))
+        self.watch("python", "a")
+        self.watch("python", "b")
+        _write(self.path("a", "python.snippets"), "a")
+        self.watcher._poll()
+        self.assertFalse(self.watcher.has_changed("python"))
+        _write(self.path("b", "python.snippets"), "a")
+        self.watcher._poll()
+        self.assertTrue(self.watcher.has_changed("python"))
+
+class Inotify_Overflow(unittest.TestCase):
+    def runTest(self):
+        watcher = create_watcher(3600)
+        if not isinstance(watcher, _InotifyWatcher):
+            return
+        d = tempfile.mkdtemp()
+        try:
+            watcher.watch("python", [ d ])
+            watcher._handle_events(struct.pack("iIII", -1,
+                _InotifyWatcher._IN_Q_OVERFLOW, 0, 0))
+            self.assertTrue(watcher.has_changed("python"))
+            watcher.clear()
+            self.assertEqual(watcher._dirs, {})
+        finally:
+            shutil.rmtree(d)
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+from bisect import bisect_right
+from itertools import islice
+
 import vim
 
 import UltiSnips._vim as _vim
+from UltiSnips.compatibility import as_unicode
 from UltiSnips.geometry import Position
 
 __all__ = ["TextObject", "EditableTextObject", "NoneditableTextObject"]
@@ -13,8 +17,19 @@ class TextObject(object):
     This base class represents any object in the text
     that has a span in any ways
     """
+    # Increased whenever a text object gets new pending moves for its
+    # children
+    _moves_generation = 0
+    # Orders updates and changes of text objects, see _tick
+    _clock = 0
+
     def __init__(self, parent, token, end = None, initial_text = "", tiebreaker = None):
         self._parent = parent
+        self._parent_idx = None # Our index in parent._childs
+        self._moves_applied = -1 # _moves_generation when we were up to date
+        self._last_update = None # _clock when _update last finished
+        self._last_change = self._tick() # _clock when our text last changed
+        self._written_text = None # Our text in Vim if we wrote it
 
         ct = None
         if end is not None: # Took 4 arguments
@@ -40,26 +55,31 @@ class TextObject(object):
         # not want to mess with their positions
         if self.current_text == gtext: return
         old_end = self._end
-        self._end = _vim.text_to_vim(
-                self._start, self._end, gtext or self._initial_text)
+        text = gtext or self._initial_text
+        self._end = _vim.text_to_vim(self._start, self._end, text)
+        self._written_text = as_unicode(text)
+        self._last_change = self._tick()
         if self._parent:
             self._parent._child_has_moved(
-                self._parent._childs.index(self), min(old_end, self._end),
+                self._parent_idx, min(old_end, self._end),
                 self._end.diff(old_end)
             )
 
-    def __lt__(self, other):
-        me = (self._start.line, self._start.col,
+    def forget_written_text(self):
+        """
+        Forgets the text we wrote, it might no longer be what is in Vim.
+        """
+        self._written_text = None
+
+    def _sort_key(self):
+        start = self._start
+        return (start.line, start.col,
                 self._tiebreaker.line, self._tiebreaker.col)
-        o = (other._start.line, other._start.col,
-                other._tiebreaker.line, other._tiebreaker.col)
-        return me < o
+
+    def __lt__(self, other):
+        return self._sort_key() < other._sort_key()
     def __le__(self, other):
-        me = (self._start.line, self._start.col,
-                self._tiebreaker.line, self._tiebreaker.col)
-        o = (other._start.line, other._start.col,
-                other._tiebreaker.line, other._tiebreaker.col)
-        return me <= o
+        return self._sort_key() <= other._sort_key()
 
     def __repr__(self):
         ct = ""
@@ -76,6 +96,11 @@ class TextObject(object):
     ##############
     @property
     def current_text(self):
+        # Our positions must be up to date before we can trust the text we
+        # wrote, see _move.
+        if (self._moves_applied == TextObject._moves_generation and
+                self._written_text is not None):
+            return self._written_text
         if self._start.line == self._end.line:
             return _vim.buf[self._start.line][self._start.col:self._end.col]
         else:
@@ -92,12 +117,84 @@ class TextObject(object):
         return self._end
     end = property(end)
 
+    # The positions are only up to date after the moves that our ancestors
+    # have not yet passed down to their children have been applied, see
+    # EditableTextObject._push_moves.
+    def _start():
+        def fget(self):
+            if self._moves_applied != TextObject._moves_generation:
+                self._apply_pending_moves()
+            return self.__start
+        def fset(self, value):
+            self._apply_pending_moves()
+            self.__start = value
+        return locals()
+    _start = property(**_start())
+
+    def _end():
+        def fget(self):
+            if self._moves_applied != TextObject._moves_generation:
+                self._apply_pending_moves()
+            return self.__end
+        def fset(self, value):
+            self._apply_pending_moves()
+            self.__end = value
+        return locals()
+    _end = property(**_end())
+
     ####################
     # Public functions #
     ####################
-    def _move(self, pivot, diff):
-        self._start.move(pivot, diff)
-        self._end.move(pivot, diff)
+    @staticmethod
+    def _tick():
+        TextObject._clock += 1
+        return TextObject._clock
+
+    def _dependencies(self):
+        """The text objects that must be done before we can be updated."""
+        return ()
+
+    def _soft_dependencies(self):
+        """
+        The text objects that should be updated before us. Unlike
+        _dependencies, these are ignored if they would make the dependencies
+        cyclic.
+        """
+        return ()
+
+    def _needs_update(self, context):
+        """
+        Returns True if our _update must be called, False if our text would
+        stay the same. context tells about Vim, see _UpdateContext.
+        """
+        return True
+
+    def _apply_pending_moves(self):
+        """Lets all ancestors pass their pending moves down to us."""
+        if self._moves_applied == TextObject._moves_generation:
+            return
+        ancestors = []
+        top = -1
+        p = self._parent
+        while p is not None:
+            if p._pending_moves:
+                top = len(ancestors)
+            ancestors.append(p)
+            p = p._parent
+        for idx in range(top, -1, -1):
+            ancestors[idx]._push_moves()
+        self._moves_applied = TextObject._moves_generation
+
+    def _move(self, moves):
+        """Applies the (pivot, diff) moves to our positions. Our ancestors
+        must have pushed their pending moves before."""
+        for pivot, diff in moves:
+            # A move that only shifts our end changed the text in our span
+            if self._written_text is not None and \
+                    self.__start < pivot <= self.__end:
+                self._written_text = None
+            self.__start.move(pivot, diff)
+            self.__end.move(pivot, diff)
 
 class EditableTextObject(TextObject):
     """
@@ -109,6 +206,8 @@ class EditableTextObject(TextObject):
 
         self._childs = []
         self._tabstops = {}
+        # Moves that still have to be applied to all our descendants
+        self._pending_moves = []
 
     ##############
     # Properties #
@@ -121,8 +220,11 @@ class EditableTextObject(TextObject):
     # Public Functions #
     ####################
     def find_parent_for_new_to(self, pos):
-        for c in self._editable_childs:
-            if (c._start <= pos < c._end):
+        for c in islice(self._childs, max(0, self._childs_before(pos) - 1),
+                None):
+            if pos < c._start:
+                break
+            if isinstance(c, EditableTextObject) and pos < c._end:
                 return c.find_parent_for_new_to(pos)
         return self
 
@@ -136,7 +238,14 @@ class EditableTextObject(TextObject):
 
         to_kill = set()
         new_cmds = []
-        for c in self._childs:
+        delend = pos + Position(0, len(text)) if text != "\n" \
+                else Position(line + 1, 0)
+        # Siblings do not overlap, so all children before the last one that
+        # starts before pos end before pos.
+        first = max(0, self._childs_before(pos) - 1)
+        for c in islice(self._childs, first, None):
+            if (delend if ctype == "D" else pos) < c._start:
+                break # This and all following children start after the edit
             if ctype == "I": # Insertion
                 if c._start < pos < Position(c._end.line, c._end.col) and isinstance(c, NoneditableTextObject):
                     to_kill.add(c)
@@ -146,8 +255,6 @@ class EditableTextObject(TextObject):
                     c._do_edit(cmd)
                     return
             else: # Deletion
-                delend = pos + Position(0, len(text)) if text != "\n" \
-                        else Position(line + 1, 0)
                 if (c._start <= pos < c._end) and (c._start < delend <= c._end):
                     # this edit command is completely for the child
                     if isinstance(c, NoneditableTextObject):
@@ -192,28 +299,66 @@ class EditableTextObject(TextObject):
             delta.line *= -1
             delta.col *= -1
         pivot = Position(line, col)
-        idx = -1
-        for cidx, c in enumerate(self._childs):
-            if c._start < pivot <= c._end:
-                idx = cidx
-        self._child_has_moved(idx, pivot, delta)
+        # Only the children that start at or after the pivot can move.
+        self._child_has_moved(self._childs_before(pivot) - 1, pivot, delta)
+
+    def _move(self, moves):
+        # Our children are only moved when their positions are needed.
+        TextObject._move(self, moves)
+        if self._childs:
+            self._pending_moves.extend(moves)
+            TextObject._moves_generation += 1
+
+    def _push_moves(self):
+        """Applies our pending moves to our children."""
+        if not self._pending_moves:
+            return
+        moves, self._pending_moves = self._pending_moves, []
+        for c in self._childs:
+            c._move(moves)
 
-    def _move(self, pivot, diff):
-        TextObject._move(self, pivot, diff)
+    def _dependencies(self):
+        return self._childs
 
+    def overwrite(self, gtext = None):
+        TextObject.overwrite(self, gtext)
+        # The text of our children has been overwritten as well
         for c in self._childs:
-            c._move(pivot, diff)
+            c.forget_written_text()
+
+    def forget_written_text(self):
+        TextObject.forget_written_text(self)
+        for c in self._childs:
+            c.forget_written_text()
 
     def _child_has_moved(self, idx, pivot, diff):
         self._end.move(pivot, diff)
+        self._last_change = self._tick()
+        self._written_text = None
 
-        for c in self._childs[idx+1:]:
-            c._move(pivot, diff)
+        self._push_moves()
+        moves = [ (Position(pivot.line, pivot.col),
+                   Position(diff.line, diff.col)) ]
+        for c in islice(self._childs, idx+1, None):
+            c._move(moves)
 
         if self._parent:
-            self._parent._child_has_moved(
-                self._parent._childs.index(self), pivot, diff
-            )
+            self._parent._child_has_moved(self._parent_idx, pivot, diff)
+
+    def _childs_before(self, pos):
+        """Returns the number of children that start before pos."""
+        lo, hi = 0, len(self._childs)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._childs[mid]._start < pos:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _reindex_childs(self, first = 0):
+        for idx in range(first, len(self._childs)):
+            self._childs[idx]._parent_idx = idx
 
     def _get_next_tab(self, no):
         if not len(self._tabstops.keys()):
@@ -275,9 +420,10 @@ class EditableTextObject(TextObject):
         if self._parent and requester is not self._parent:
             return self._parent._get_tabstop(self, no)
 
-    def _update(self, done, not_done):
+    def _update(self, done, not_done, context):
         """
-        Update this object inside the Vim Buffer.
+        Update this object inside the Vim Buffer. context tells about Vim,
+        see _UpdateContext.
 
         Return False if you want to be called again
         for this edit cycle. Otherwise return True.
@@ -289,12 +435,18 @@ class EditableTextObject(TextObject):
         return True
 
     def _add_child(self,c):
-        self._childs.append(c)
-        self._childs.sort()
+        # The pending moves are not meant for the new child.
+        self._apply_pending_moves()
+        self._push_moves()
+        idx = bisect_right(self._childs, c)
+        self._childs.insert(idx, c)
+        self._reindex_childs(idx)
 
     def _del_child(self,c):
         c._parent = None
-        self._childs.remove(c)
+        del self._childs[c._parent_idx]
+        self._reindex_childs(c._parent_idx)
+        c._parent_idx = None
 
         # If this is a tabstop, delete it
         try:
@@ -307,6 +459,6 @@ class NoneditableTextObject(TextObject):
     All passive text objects that the user can't edit by hand
     """
 
-    def _update(self, done, not_done):
+    def _update(self, done, not_done, context):
         return True
 
@@ -6,6 +6,7 @@ Not really a Lexer in the classical sense, but code to hack Snippet Definitions
 into Logical Units called Tokens.
 """
 
+import copy
 import string
 import re
 
@@ -13,12 +14,16 @@ from UltiSnips.geometry import Position
 from UltiSnips.compatibility import as_unicode
 
 __all__ = [
-    "tokenize", "EscapeCharToken", "VisualToken", "TransformationToken", "TabStopToken",
-    "MirrorToken", "PythonCodeToken", "VimLCodeToken", "ShellCodeToken"
+    "tokenize", "compile_tokens", "rebase_tokens", "EscapeCharToken",
+    "VisualToken", "TransformationToken", "TabStopToken", "MirrorToken",
+    "PythonCodeToken", "VimLCodeToken", "ShellCodeToken"
 ]
 
 # Helper Classes  {{{
 class _TextIterator(object):
+    # All tokens start with one of these characters
+    _TOKEN_START = re.compile(r"[$`\\]")
+
     def __init__(self, text, offset):
         self._text = as_unicode(text)
         self._line = offset.line
@@ -29,6 +34,32 @@ class _TextIterator(object):
     def __iter__(self):
         return self
 
+    def _advance(self, end):
+        """Moves to index end and returns the text that was passed."""
+        rv = self._text[self._idx:end]
+        newlines = rv.count('\n')
+        if newlines:
+            self._line += newlines
+            self._col = len(rv) - rv.rfind('\n') - 1
+        else:
+            self._col += len(rv)
+        self._idx = end
+        return rv
+
+    def read_until(self, regex):
+        """Consumes and returns all text before the next match of regex, or
+        the rest of the text if there is none."""
+        m = regex.search(self._text, self._idx)
+        return self._advance(m.start() if m else len(self._text))
+
+    def skip_plain_text(self):
+        """Consumes the current character and all following ones that can
+        not start a token."""
+        if self._idx >= len(self._text):
+            raise StopIteration
+        m = self._TOKEN_START.search(self._text, self._idx + 1)
+        self._advance(m.start() if m else len(self._text))
+
     def next(self):
         if self._idx >= len(self._text):
             raise StopIteration
@@ -69,6 +100,9 @@ def unescape(s):
 
 # End: Helper Classes  }}}
 # Helper functions  {{{
+_BRACE_OR_ESCAPE = re.compile(r"[{}\\]")
+_CHAR_OR_ESCAPE = {}
+
 def _parse_number(stream):
     """
     Expects the stream to contain a number next, returns the number
@@ -90,6 +124,7 @@ def _parse_till_closing_brace(stream):
     rv = ""
     in_braces = 1
     while True:
+        rv += stream.read_until(_BRACE_OR_ESCAPE)
         if EscapeCharToken.starts_here(stream, '{}'):
             rv += stream.next() + stream.next()
         else:
@@ -107,8 +142,13 @@ def _parse_till_unescaped_char(stream, chars):
     Will also consume the closing char, but and return it as second
     return value
     """
+    if chars not in _CHAR_OR_ESCAPE:
+        _CHAR_OR_ESCAPE[chars] = re.compile(r"[%s\\]" % re.escape(chars))
+    stop = _CHAR_OR_ESCAPE[chars]
+
     rv = ""
     while True:
+        rv += stream.read_until(stop)
         escaped = False
         for c in chars:
             if EscapeCharToken.starts_here(stream, c):
@@ -309,23 +349,56 @@ class EndOfTextToken(Token):
         return "EndOfText(%r)" % self.end
 # End: Tokens  }}}
 
-__ALLOWED_TOKENS = [
-    EscapeCharToken, VisualToken, TransformationToken, TabStopToken, MirrorToken,
-    PythonCodeToken, VimLCodeToken, ShellCodeToken
-]
+# The tokens that can start with a character, in the order they are tried
+__ALLOWED_TOKENS = {
+    '\\': [ EscapeCharToken ],
+    '$': [ VisualToken, TransformationToken, TabStopToken, MirrorToken ],
+    '`': [ PythonCodeToken, VimLCodeToken, ShellCodeToken ],
+}
 def tokenize(text, indent, offset):
     stream = _TextIterator(text, offset)
 
     try:
         while True:
             done_something = False
-            for t in __ALLOWED_TOKENS:
+            for t in __ALLOWED_TOKENS.get(stream.peek(), ()):
                 if t.starts_here(stream):
                     yield t(stream, indent)
                     done_something = True
                     break
             if not done_something:
-                stream.next()
+                stream.skip_plain_text()
     except StopIteration:
         yield EndOfTextToken(stream, indent)
 
+
+def compile_tokens(text, indent):
+    """
+    Tokenizes text as if it started at (0,0). The content of each tabstop is
+    compiled as well and stored in its child_tokens, relative to the start of
+    the tabstop. The result can be reused; rebase_tokens places it in the
+    buffer.
+    """
+    tokens = list(tokenize(text, indent, Position(0, 0)))
+    for token in tokens:
+        if isinstance(token, TabStopToken):
+            token.child_tokens = compile_tokens(token.initial_text, indent)
+    return tokens
+
+def _rebase(pos, offset):
+    if pos.line == 0:
+        return Position(offset.line, offset.col + pos.col)
+    return Position(offset.line + pos.line, pos.col)
+
+def rebase_tokens(tokens, offset):
+    """
+    Returns copies of the compiled tokens moved so that (0,0) is at offset.
+    Each copy gets new positions, the compiled tokens are not changed.
+    """
+    rv = []
+    for token in tokens:
+        token = copy.copy(token)
+        token.start = _rebase(token.start, offset)
+        token.end = _rebase(token.end, offset)
+        rv.append(token)
+    return rv
@@ -12,7 +12,17 @@ class Mirror(NoneditableTextObject):
 
         self._ts = tabstop
 
-    def _update(self, done, not_done):
+    def _dependencies(self):
+        if self._ts.is_killed:
+            return ()
+        return (self._ts,)
+
+    def _needs_update(self, context):
+        # We only change when our tabstop does
+        return (self._last_update is None or self._ts.is_killed or
+                self._ts._last_change > self._last_update)
+
+    def _update(self, done, not_done, context):
         if self._ts.is_killed:
             self.overwrite("")
             self._parent._del_child(self)
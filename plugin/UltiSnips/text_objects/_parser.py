@@ -2,9 +2,9 @@
 # encoding: utf-8
 
 from UltiSnips.geometry import Position
-from UltiSnips.text_objects._lexer import tokenize, EscapeCharToken, VisualToken, \
-    TransformationToken, TabStopToken, MirrorToken, PythonCodeToken, \
-    VimLCodeToken, ShellCodeToken
+from UltiSnips.text_objects._lexer import tokenize, rebase_tokens, \
+    EscapeCharToken, VisualToken, TransformationToken, TabStopToken, \
+    MirrorToken, PythonCodeToken, VimLCodeToken, ShellCodeToken
 from UltiSnips.text_objects._escaped_char import EscapedChar
 from UltiSnips.text_objects._mirror import Mirror
 from UltiSnips.text_objects._python_code import PythonCode
@@ -25,13 +25,16 @@ class TOParser(object):
         VimLCodeToken: VimLCode,
     }
 
-    def __init__(self, parent_to, text, indent):
+    def __init__(self, parent_to, text, indent, compiled = None):
         """
-        The parser is responsible for turning tokens into Real TextObjects
+        The parser is responsible for turning tokens into Real TextObjects.
+        If compiled is given, it must be the result of compile_tokens for
+        text and indent and is used instead of tokenizing text again.
         """
         self._indent = indent
         self._parent_to = parent_to
         self._text = text
+        self._compiled = compiled
 
     def parse(self, add_ts_zero = False):
         seen_ts = {}
@@ -68,7 +71,10 @@ class TOParser(object):
                 Transformation(parent, seen_ts[token.no], token)
 
     def _do_parse(self, all_tokens, seen_ts):
-        tokens = list(tokenize(self._text, self._indent, self._parent_to.start))
+        if self._compiled is None:
+            tokens = list(tokenize(self._text, self._indent, self._parent_to.start))
+        else:
+            tokens = rebase_tokens(self._compiled, self._parent_to.start)
 
         for token in tokens:
             all_tokens.append((self._parent_to, token))
@@ -77,7 +83,8 @@ class TOParser(object):
                 ts = TabStop(self._parent_to, token)
                 seen_ts[token.no] = ts
 
-                k = TOParser(ts, token.initial_text, self._indent)
+                k = TOParser(ts, token.initial_text, self._indent,
+                        getattr(token, "child_tokens", None))
                 k._do_parse(all_tokens, seen_ts)
             else:
                 klass = self.TOKEN2TO.get(token.__class__, None)
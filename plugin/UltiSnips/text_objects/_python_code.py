@@ -1,26 +1,253 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import ast
 import os
 import re
 from collections import namedtuple
+try:
+    import builtins as _builtins
+except ImportError:
+    import __builtin__ as _builtins
 
 import UltiSnips._vim as _vim
 from UltiSnips.compatibility import compatible_exec, as_unicode
 from UltiSnips.util import IndentUtil
 
-from UltiSnips.text_objects._base import NoneditableTextObject
+from UltiSnips.text_objects._base import TextObject, NoneditableTextObject
+
+# Code objects of the python interpolations by their source, shared by all
+# snippet instances. It is emptied when it grows beyond _MAX_COMPILED_CODE
+# entries, anonymous snippets can bring in new code all the time.
+_compiled_code = {}
+_MAX_COMPILED_CODE = 1000
+
+def _compile(code):
+    """Returns the compiled code object for the python source code."""
+    try:
+        return _compiled_code[code]
+    except KeyError:
+        if len(_compiled_code) >= _MAX_COMPILED_CODE:
+            _compiled_code.clear()
+        rv = _compiled_code[code] = compile(code, "<string>", "exec")
+        return rv
+
+# Whether python code is pure by its global source and its own source, see
+# _is_pure
+_pure_code = {}
+
+def _code_is_pure(globals, code):
+    """True if the python code is pure when run with globals."""
+    source = _global_source(globals)
+    try:
+        return _pure_code[source, code]
+    except KeyError:
+        pass
+    namespace = _global_namespace(globals)
+    try:
+        rv = _is_pure(ast.parse(code), namespace,
+                _pure_functions(source, namespace))
+    except SyntaxError:
+        rv = False
+    if len(_pure_code) >= _MAX_COMPILED_CODE:
+        _pure_code.clear()
+    _pure_code[source, code] = rv
+    return rv
+
+# The namespaces that result from running the global python code of the
+# loaded snippet files by its source, see _global_namespace
+_global_namespaces = {}
+
+def _global_source(globals):
+    """Returns the joined global python code in globals."""
+    return "\n".join(globals.get("!p", [])).replace("\r\n", "\n")
+
+def _global_namespace(globals):
+    """
+    Returns the namespace that results from running the global python code
+    in globals, followed by some convenient imports. It is only computed once
+    for each source until the snippet files are reloaded and must not be
+    changed.
+    """
+    source = _global_source(globals)
+    try:
+        return _global_namespaces[source]
+    except KeyError:
+        pass
+    namespace = {}
+    compatible_exec(_compile(source), namespace)
+    compatible_exec(_compile("import re, os, vim, string, random"),
+            namespace)
+    _global_namespaces[source] = namespace
+    return namespace
+
+def forget_global_namespaces():
+    """
+    Forgets the results of running global python code, the compiled code and
+    what is known about it. This must be called when snippet files are
+    reloaded.
+    """
+    _global_namespaces.clear()
+    _compiled_code.clear()
+    _pure_code.clear()
+
+# Builtins, modules and attributes that give the same result every time they
+# are used with the same arguments and change nothing, see _is_pure
+_PURE_BUILTINS = frozenset((
+    "abs", "all", "any", "basestring", "bool", "chr", "dict", "divmod",
+    "enumerate", "filter", "float", "format", "frozenset", "hex", "int",
+    "isinstance", "issubclass", "len", "list", "long", "map", "max", "min",
+    "oct", "ord", "pow", "range", "reduce", "repr", "reversed", "round", "set",
+    "slice", "sorted", "str", "sum", "tuple", "unichr", "unicode", "xrange",
+    "zip", "True", "False", "None", "Exception", "IndexError", "KeyError",
+    "TypeError", "ValueError",
+))
+_PURE_MODULES = frozenset(("os", "re", "string"))
+_PURE_ATTRIBUTES = frozenset([ name for name in
+    dir("") + dir(as_unicode("")) if not name.startswith("_") ] + [
+    # Reading lists and dicts
+    "copy", "get", "has_key", "items", "iteritems", "iterkeys", "itervalues",
+    "keys", "values",
+    # os.path
+    "altsep", "basename", "commonprefix", "dirname", "extsep", "normpath",
+    "path", "pathsep", "sep", "splitext",
+    # re, its patterns and matches
+    "A", "ASCII", "DOTALL", "I", "IGNORECASE", "L", "LOCALE", "M",
+    "MULTILINE", "S", "U", "UNICODE", "VERBOSE", "X", "compile", "end",
+    "endpos", "escape", "findall", "finditer", "flags", "group", "groupdict",
+    "groups", "lastgroup", "lastindex", "match", "pattern", "pos", "search",
+    "span", "start", "string", "sub", "subn",
+    # string
+    "ascii_letters", "ascii_lowercase", "ascii_uppercase", "capwords",
+    "digits", "hexdigits", "letters", "lowercase", "octdigits", "printable",
+    "punctuation", "uppercase", "whitespace",
+    # snip, see SnippetUtil
+    "c", "indent", "mkline", "mode", "reset_indent", "rv", "shift", "text",
+    "unshift", "v",
+])
+_IMMUTABLE_TYPES = (type(None), bool, int, type(1 << 64), float,
+        type(""), type(as_unicode("")), tuple, frozenset)
+# Statements that can do anything or keep state between runs
+_IMPURE_STATEMENTS = tuple(getattr(ast, name) for name in
+        ("Import", "ImportFrom", "Global", "Nonlocal", "Exec", "Print")
+        if hasattr(ast, name))
+
+def _is_pure(tree, namespace, pure_functions):
+    """
+    True if the python code in the ast tree only reads its inputs and
+    changes nothing but its own variables, so that it gives the same result
+    when run again with the same inputs. namespace is the namespace the code
+    runs in and pure_functions the names of the functions in it that are
+    pure. This is conservative: code that uses anything that is not known to
+    be pure is not.
+    """
+    assigned = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            assigned.add(node.id)
+        elif type(node).__name__ == "arg": # Arguments of functions in Py3
+            assigned.add(node.arg)
+    for node in ast.walk(tree):
+        if isinstance(node, _IMPURE_STATEMENTS):
+            return False
+        elif isinstance(node, ast.Attribute):
+            if node.attr not in _PURE_ATTRIBUTES:
+                return False
+        elif isinstance(node, ast.Subscript):
+            # Changing a value that might be shared
+            if not isinstance(node.ctx, ast.Load) and not (
+                    isinstance(node.value, ast.Name) and
+                    node.value.id in assigned):
+                return False
+        elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+            name = node.id
+            if name in assigned:
+                continue
+            if name in namespace:
+                value = namespace[name]
+                if not (name in pure_functions or
+                        isinstance(value, _IMMUTABLE_TYPES) or
+                        getattr(value, "__name__", None) in _PURE_MODULES):
+                    return False
+            elif hasattr(_builtins, name) and name not in _PURE_BUILTINS:
+                return False
+    return True
+
+def _pure_functions(source, namespace):
+    """
+    Returns the names of the functions defined at the top of the global
+    python code source that are pure, see _is_pure.
+    """
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return frozenset()
+    functions = {}
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef):
+            functions[node.name] = node
+    # Functions that are redefined or replaced later are not trusted
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            functions.pop(node.id, None)
+    # Start with all of them and drop the impure ones until none is left
+    pure = set(functions)
+    changed = True
+    while changed:
+        changed = False
+        for name in list(pure):
+            if not _is_pure(functions[name], namespace, pure):
+                pure.discard(name)
+                changed = True
+    return frozenset(pure)
 
 class _Tabs(object):
-    def __init__(self, to):
+    def __init__(self, to, read = None):
         self._to = to
+        self._read = read # Gets the tabstops we returned by number
 
     def __getitem__(self, no):
         ts = self._to._get_tabstop(self._to, int(no))
+        if self._read is not None:
+            self._read[int(no)] = ts
         if ts is None:
             return ""
         return ts.current_text
 
+class PythonLocals(dict):
+    """
+    The locals that all python code in a snippet shares. Remembers when each
+    name was last assigned and can record which names are looked up by
+    executing code.
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._assigned = {}
+        self._looked_up = None
+
+    def record_lookups(self):
+        """Starts recording the names that are looked up."""
+        self._looked_up = set()
+
+    def recorded_lookups(self):
+        """Stops recording and returns the names looked up since
+        record_lookups."""
+        rv, self._looked_up = self._looked_up, None
+        return rv
+
+    def assigned_since(self, name, clock):
+        """True if name was assigned after TextObject._clock was clock."""
+        return self._assigned.get(name, 0) > clock
+
+    def __getitem__(self, name):
+        if self._looked_up is not None:
+            self._looked_up.add(name)
+        return dict.__getitem__(self, name)
+
+    def __setitem__(self, name, value):
+        self._assigned[name] = TextObject._tick()
+        dict.__setitem__(self, name, value)
+
 _VisualContent = namedtuple('_VisualContent', ['mode', 'text'])
 class SnippetUtil(object):
     """ Provides easy access to indentation, etc.
@@ -32,17 +259,20 @@ class SnippetUtil(object):
 
         self._initial_indent = self._ind.indent_to_spaces(initial_indent)
 
-        self._reset("")
+        self._reset("", self._ind)
 
-    def _reset(self, cur):
+    def _reset(self, cur, ind):
         """ Gets the snippet ready for another update.
 
         :cur: the new value for c.
+        :ind: an IndentUtil for the current indentation settings.
         """
-        self._ind.reset()
+        self._ind = ind
         self._c = cur
         self._rv = ""
         self._changed = False
+        self._read_c = False
+        self._used_indent = False
         self.reset_indent()
 
     def shift(self, amount=1):
@@ -52,6 +282,7 @@ class SnippetUtil(object):
 
         :amount: the amount by which to shift.
         """
+        self._used_indent = True
         self.indent += " " * self._ind.sw * amount
 
     def unshift(self, amount=1):
@@ -61,6 +292,7 @@ class SnippetUtil(object):
 
         :amount: the amount by which to unshift.
         """
+        self._used_indent = True
         by = -self._ind.sw * amount
         try:
             self.indent = self.indent[:by]
@@ -74,6 +306,7 @@ class SnippetUtil(object):
         :indent: the indentation to have at the beginning
                  if None, it uses the default amount
         """
+        self._used_indent = True
         if indent == None:
             indent = self.indent
             # this deals with the fact that the first line is
@@ -134,6 +367,7 @@ class SnippetUtil(object):
 
         Deprecates cur.
         """
+        self._read_c = True
         return self._c
 
     @property
@@ -167,6 +401,10 @@ class SnippetUtil(object):
 
 
 class PythonCode(NoneditableTextObject):
+    _TABSTOP_REFERENCE = re.compile(r"\bt\[\s*(\d+)\s*\]")
+    # The names we set before running the code
+    _OWN_NAMES = ('t', 'fn', 'path', 'cur', 'res', 'snip')
+
     def __init__(self, parent, token):
         code = token.code.replace("\\`", "`")
 
@@ -182,27 +420,71 @@ class PythonCode(NoneditableTextObject):
                 snippet = snippet._parent
         self._snip = SnippetUtil(token.indent, m, t)
 
-        self._globals = {}
-        globals = snippet.globals.get("!p", [])
-        compatible_exec("\n".join(globals).replace("\r\n", "\n"), self._globals)
+        # Names that our code defines with a global statement stay ours
+        self._globals = dict(_global_namespace(snippet.globals))
+        self._code = _compile(code)
 
-        # Add Some convenience to the code
-        self._code = "import re, os, vim, string, random\n" + code
+        # The tabstops we read: the ones that are obviously referenced in the
+        # code and the ones that were accessed when it last ran.
+        self._referenced = set(int(no) for no in
+                self._TABSTOP_REFERENCE.findall(code))
+        self._accessed = set()
+
+        # What the code read when it last ran, see _needs_update
+        self._always_run = not _code_is_pure(snippet.globals, code)
+        self._inputs = None
 
         NoneditableTextObject.__init__(self, parent, token)
 
-    def _update(self, done, not_done):
-        path = _vim.eval('expand("%")')
-        if path is None:
-            path = ""
+    def _soft_dependencies(self):
+        rv = set(ts for ts in self._accessed if not ts.is_killed)
+        for no in self._referenced:
+            ts = self._parent._get_tabstop(self._parent, no)
+            if ts is not None:
+                rv.add(ts)
+        return rv
+
+    def _needs_update(self, context):
+        """
+        We only run again if something that the code read when it last ran
+        has changed: the tabstops, the file name, the shared locals, the
+        indentation settings or our own text. Code that is not pure always
+        runs.
+        """
+        if self._always_run or self._inputs is None:
+            return True
+        tabs, names, path, indent, ran_at, last_change = self._inputs
+        if self._last_change != last_change:
+            return True
+        for no, (ts, ts_change) in tabs.items():
+            now = self._parent._get_tabstop(self._parent, no)
+            if now is not ts or (ts is not None and
+                    (ts.is_killed or ts._last_change != ts_change)):
+                return True
+        for name in names:
+            if self._locals.assigned_since(name, ran_at):
+                return True
+        if path is not None and path != context.path:
+            return True
+        if indent is not None and indent != self._indent_settings(context):
+            return True
+        return False
+
+    def _indent_settings(self, context):
+        ind = context.indent
+        return (ind.sw, ind.sts, ind.et, ind.ts)
+
+    def _update(self, done, not_done, context):
+        path = context.path
         fn = os.path.basename(path)
 
         ct = self.current_text
-        self._snip._reset(ct)
+        self._snip._reset(ct, context.indent)
         local_d = self._locals
 
+        tabs = {}
         local_d.update({
-            't': _Tabs(self._parent),
+            't': _Tabs(self._parent, tabs),
             'fn': fn,
             'path': path,
             'cur': ct,
@@ -210,14 +492,43 @@ class PythonCode(NoneditableTextObject):
             'snip' : self._snip,
         })
 
-        compatible_exec(self._code, self._globals, local_d)
+        self._inputs = None
+        if self._always_run:
+            # The code might change the buffer through vim directly
+            _vim.buf.note_untracked_writes()
+        local_d.record_lookups()
+        try:
+            compatible_exec(self._code, self._globals, local_d)
+        finally:
+            names = local_d.recorded_lookups()
+
+        read = {}
+        for no, ts in tabs.items():
+            if ts is None:
+                read[no] = (None, None)
+            else:
+                read[no] = (ts, ts._last_change)
+                self._accessed.add(ts)
+        if not names.intersection(('fn', 'path')):
+            path = None
+        indent = None
+        if self._snip._used_indent:
+            indent = self._indent_settings(context)
+        ran_at = TextObject._tick()
 
         rv = as_unicode(self._snip.rv if self._snip._rv_changed
                 else as_unicode(local_d['res']))
 
+        last_change = self._last_change
         if ct != rv:
             self.overwrite(rv)
-            return False
-        return True
+            # Our new text only makes us run again if the code read it, to
+            # see that it settled.
+            if not (names.intersection(('cur', 'res')) or
+                    self._snip._read_c):
+                last_change = self._last_change
+        self._inputs = (read, names.difference(self._OWN_NAMES), path,
+                indent, ran_at, last_change)
+        return ct == rv
 
 
@@ -2,41 +2,157 @@
 # encoding: utf-8
 
 import os
+import signal
 import subprocess
 import stat
 import tempfile
+import threading
 
 from UltiSnips.compatibility import as_unicode
 from UltiSnips.text_objects._base import NoneditableTextObject
 
+__all__ = [ "ShellCode", "finished_shell_code", "shell_code_running" ]
+
+# The ShellCode objects whose command runs in the background
+_running = []
+
+def finished_shell_code(root, wait = False):
+    """
+    Returns the ShellCode objects in the snippet root whose command has
+    finished in the background since the last call. With wait, the commands
+    of root that still run are waited for. The objects that are no longer
+    part of root are dropped once their command finished.
+    """
+    rv = []
+    for sc in list(_running):
+        ours = sc._root() is root
+        if wait and ours:
+            sc._job.join()
+        if sc._job.is_alive():
+            continue
+        _running.remove(sc)
+        if ours:
+            rv.append(sc)
+    return rv
+
+def shell_code_running():
+    """True if there are commands running in the background."""
+    return len(_running) > 0
+
+def _run(code, timeout = None):
+    """
+    Runs code as a script and returns what it printed to stdout. Returns None
+    if it did not finish within timeout seconds. This does not talk to Vim,
+    so it can be called from any thread.
+    """
+    # Write the code to a temporary file
+    handle, path = tempfile.mkstemp(text=True)
+    os.write(handle, code.encode("utf-8"))
+    os.close(handle)
+    os.chmod(path, stat.S_IRWXU)
+
+    try:
+        # Execute the file and read stdout. The command gets its own process
+        # group, so that it can be killed together with its children.
+        new_group = timeout and hasattr(os, "setsid")
+        proc = subprocess.Popen(path, shell=True, stdout=subprocess.PIPE,
+                preexec_fn = os.setsid if new_group else None)
+
+        timed_out = []
+        def _kill():
+            timed_out.append(True)
+            if new_group:
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+        killer = None
+        if timeout:
+            killer = threading.Timer(timeout, _kill)
+            killer.start()
+        output = proc.communicate()[0]
+        if killer is not None:
+            killer.cancel()
+    finally:
+        os.unlink(path)
+
+    if timed_out:
+        return None
+    return output
+
+class _Job(threading.Thread):
+    """Runs a command in the background, see _run."""
+
+    def __init__(self, code, timeout):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._code = code
+        self._timeout = timeout
+        self.output = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.output = _run(self._code, self._timeout)
+        except Exception as e:
+            self.error = e
+
 class ShellCode(NoneditableTextObject):
+    # Shown while the command runs in the background
+    _PLACEHOLDER = "..."
+
     def __init__(self, parent, token):
         NoneditableTextObject.__init__(self, parent, token)
 
         self._code = token.code.replace("\\`", "`")
+        self._job = None
+
+    def _update(self, done, not_done, context):
+        if self._job is not None:
+            return True # Our command is still running
+
+        if not context.async_shell_code:
+            self._replace_by(_run(self._code))
+            return True
+
+        self._job = _Job(self._code, context.shell_code_timeout)
+        _running.append(self)
+        self.overwrite(self._PLACEHOLDER)
+        return True
+
+    def finish(self):
+        """
+        Replaces us by the output of our command that ran in the background.
+        The command must have finished. Output of a command that timed out is
+        dropped, as is the output for a placeholder that is no longer in the
+        buffer.
+        """
+        if self._job.error is not None:
+            raise self._job.error
+        self.forget_written_text()
+        if self.current_text != self._PLACEHOLDER:
+            return
+        self._replace_by(self._job.output)
 
-    def _update(self, done, not_done):
-        # Write the code to a temporary file
-        handle, path = tempfile.mkstemp(text=True)
-        os.write(handle, self._code.encode("utf-8"))
-        os.close(handle)
-        os.chmod(path, stat.S_IRWXU)
+    def _root(self):
+        """
+        The snippet we are part of. If we were deleted, this is the top of
+        what we are still attached to.
+        """
+        obj = self
+        while obj._parent is not None:
+            obj = obj._parent
+        return obj
 
-        # Execute the file and read stdout
-        proc = subprocess.Popen(path, shell=True, stdout=subprocess.PIPE)
-        proc.wait()
-        output = as_unicode(proc.stdout.read())
+    def _replace_by(self, output):
+        if output is None:
+            output = ""
+        output = as_unicode(output)
 
         if len(output) and output[-1] == '\n':
             output = output[:-1]
         if len(output) and output[-1] == '\r':
             output = output[:-1]
 
-        os.unlink(path)
-
         self.overwrite(output)
         self._parent._del_child(self)
-
-        return True
-
-
@@ -1,11 +1,18 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import heapq
+
 from UltiSnips.geometry import Position
 import UltiSnips._vim as _vim
+from UltiSnips.util import IndentUtil
 
-from UltiSnips.text_objects._base import EditableTextObject, NoneditableTextObject
+from UltiSnips.text_objects._base import TextObject, EditableTextObject, \
+        NoneditableTextObject
+from UltiSnips.text_objects._mirror import Mirror
 from UltiSnips.text_objects._parser import TOParser
+from UltiSnips.text_objects._python_code import PythonCode, PythonLocals
+from UltiSnips.text_objects._tabstop import TabStop
 
 class SnippetInstance(EditableTextObject):
     """
@@ -15,7 +22,7 @@ class SnippetInstance(EditableTextObject):
     also a TextObject because it has a start an end
     """
 
-    def __init__(self, parent, indent, initial_text, start, end, visual_content, last_re, globals):
+    def __init__(self, parent, indent, initial_text, start, end, visual_content, last_re, globals, compiled = None):
         if start is None:
             start = Position(0,0)
         if end is None:
@@ -23,13 +30,13 @@ class SnippetInstance(EditableTextObject):
 
         self._cts = 0
 
-        self.locals = {"match" : last_re}
+        self.locals = PythonLocals(match = last_re)
         self.globals = globals
         self.visual_content = visual_content
 
         EditableTextObject.__init__(self, parent, start, end, initial_text)
 
-        TOParser(self, initial_text, indent).parse(True)
+        TOParser(self, initial_text, indent, compiled).parse(True)
 
         self.update_textobjects()
 
@@ -54,25 +61,53 @@ class SnippetInstance(EditableTextObject):
         the users edits have been replayed. This might also move the Cursor
         """
         vc = _VimCursor(self)
+        context = _UpdateContext()
 
-        done = set()
-        not_done = set()
-        def _find_recursive(obj):
-            if isinstance(obj, EditableTextObject):
-                for c in obj._childs:
-                    _find_recursive(c)
-            not_done.add(obj)
-        _find_recursive(self)
+        order, cycle = _update_order(self)
 
+        done = set()
+        not_done = set(order)
         counter = 10
         while (done != not_done) and counter:
-            for obj in sorted(not_done - done): # Order matters for python locals!
-                if obj._update(done, not_done):
-                    done.add(obj)
+            if cycle:
+                # Without an order that works, everything that is not done
+                # runs in each pass, ordered by its current position.
+                order = sorted(not_done - done)
+            for obj in order:
+                if obj in done:
+                    continue
+                # Objects created while updating have no say in the order
+                if not cycle and not all(d in done or d not in not_done
+                        for d in obj._dependencies()):
+                    continue
+                if cycle or obj._needs_update(context):
+                    # Only a finished update counts, an object that has to
+                    # wait for others must be updated again
+                    started = TextObject._tick()
+                    if not obj._update(done, not_done, context):
+                        continue
+                    obj._last_update = started
+                done.add(obj)
             counter -= 1
         if counter == 0:
-            raise RuntimeError("Cyclic dependency in Snippet definition!")
+            if not cycle:
+                cycle = [ obj for obj in order
+                        if obj not in done and obj is not self ]
+            raise RuntimeError("Cyclic dependency in Snippet definition: %s" %
+                    " -> ".join(_name(obj) for obj in cycle))
+
+        vc.to_vim()
+        self._del_child(vc)
 
+    def finish_shell_code(self, shell_codes):
+        """
+        Puts the output of the finished ShellCode objects shell_codes into
+        the buffer and updates the text objects that depend on it.
+        """
+        vc = _VimCursor(self)
+        for sc in shell_codes:
+            sc.finish()
+        self.update_textobjects()
         vc.to_vim()
         self._del_child(vc)
 
@@ -123,3 +158,141 @@ class _VimCursor(NoneditableTextObject):
         assert(self._start == self._end)
         _vim.buf.cursor = self._start
 
+class _UpdateContext(object):
+    """
+    What text objects need to know about Vim during one update of a snippet.
+    Vim is asked at most once per update, no matter how many text objects
+    want to know.
+    """
+
+    def __init__(self):
+        self._path = None
+        self._indent = None
+        self._async_shell_code = None
+        self._shell_code_timeout = None
+
+    @property
+    def path(self):
+        """The path of the current buffer."""
+        if self._path is None:
+            self._path = _vim.eval('expand("%")') or ""
+        return self._path
+
+    @property
+    def indent(self):
+        """An IndentUtil for the indentation settings of the buffer."""
+        if self._indent is None:
+            self._indent = IndentUtil()
+        return self._indent
+
+    @property
+    def async_shell_code(self):
+        """True if shell code should run in the background. This needs Vim's
+        timers to put the output into the buffer when it is done."""
+        if self._async_shell_code is None:
+            self._async_shell_code = (
+                _vim.eval('exists("g:UltiSnipsAsyncShellCode")') == "1" and
+                _vim.eval("g:UltiSnipsAsyncShellCode") != "0" and
+                _vim.eval('has("timers")') == "1")
+        return self._async_shell_code
+
+    @property
+    def shell_code_timeout(self):
+        """The number of seconds shell code may run in the background. None
+        means no limit."""
+        if self._shell_code_timeout is None:
+            if _vim.eval('exists("g:UltiSnipsShellCodeTimeout")') == "0":
+                self._shell_code_timeout = 10
+            else:
+                self._shell_code_timeout = float(
+                        _vim.eval("g:UltiSnipsShellCodeTimeout"))
+        return self._shell_code_timeout or None
+
+def _name(obj):
+    """A name for obj that the user can find in the snippet definition."""
+    if isinstance(obj, TabStop):
+        return "$%i" % obj.no
+    if isinstance(obj, Mirror):
+        return "%s of $%i" % (obj.__class__.__name__, obj._ts.no)
+    return "%s at %i:%i" % (obj.__class__.__name__,
+            obj.start.line + 1, obj.start.col + 1)
+
+def _find_cycle(objs, dependencies):
+    """Returns a list of objects that depend on each other in a circle."""
+    for start in objs:
+        path, seen = [ start ], set([start])
+        while True:
+            deps = [ d for d in dependencies[path[-1]] if d in objs ]
+            if not deps:
+                break
+            if deps[0] in seen:
+                return path[path.index(deps[0]):] + [ deps[0] ]
+            path.append(deps[0])
+            seen.add(deps[0])
+    return []
+
+def _topological_order(objs, dependencies):
+    """
+    Returns objs so that every object comes after its dependencies and the
+    objects otherwise keep their order. Returns the objects that could not be
+    ordered as the second element.
+    """
+    index = dict((obj, idx) for idx, obj in enumerate(objs))
+    waiting_for = {}
+    dependents = dict((obj, []) for obj in objs)
+    for obj in objs:
+        deps = set(d for d in dependencies[obj] if d in dependents)
+        waiting_for[obj] = len(deps)
+        for d in deps:
+            dependents[d].append(obj)
+
+    ready = [ (index[obj], obj) for obj in objs if not waiting_for[obj] ]
+    heapq.heapify(ready)
+    rv = []
+    while ready:
+        obj = heapq.heappop(ready)[1]
+        rv.append(obj)
+        for d in dependents[obj]:
+            waiting_for[d] -= 1
+            if not waiting_for[d]:
+                heapq.heappush(ready, (index[d], d))
+    return rv, set(obj for obj in objs if waiting_for[obj])
+
+def _update_order(snippet):
+    """
+    Returns all text objects of snippet in the order they should be updated:
+    tabstops after their content, mirrors after their tabstops and python
+    code after the tabstops it reads from and after the python code before it
+    (as they share their locals). The python code is ordered by position if
+    this would be cyclic. If the snippet has real cyclic dependencies, the
+    objects are ordered by position and the cycle is returned as the second
+    element.
+    """
+    # Children come before their parents and after their previous siblings,
+    # which is the order of the text for everything that is not a parent.
+    objs = []
+    def _find_recursive(obj):
+        if isinstance(obj, EditableTextObject):
+            for c in obj._childs:
+                _find_recursive(c)
+        objs.append(obj)
+    _find_recursive(snippet)
+
+    hard, soft = {}, {}
+    last_python = None
+    for obj in objs:
+        hard[obj] = list(obj._dependencies())
+        soft[obj] = hard[obj] + list(obj._soft_dependencies())
+        if isinstance(obj, PythonCode):
+            if last_python is not None:
+                soft[obj].append(last_python)
+            last_python = obj
+
+    order, unordered = _topological_order(objs, soft)
+    if not unordered:
+        return order, []
+    order, unordered = _topological_order(objs, hard)
+    if not unordered:
+        return order, []
+    return sorted(objs, key = lambda o: o._sort_key()), \
+            list(reversed(_find_cycle(unordered, hard)))
@@ -4,7 +4,6 @@
 import re
 
 import UltiSnips._vim as _vim
-from UltiSnips.util import IndentUtil
 from UltiSnips.text_objects._transformation import TextObjectTransformation
 from UltiSnips.text_objects._base import NoneditableTextObject
 
@@ -33,12 +32,12 @@ class Visual(NoneditableTextObject,TextObjectTransformation):
         NoneditableTextObject.__init__(self, parent, token)
         TextObjectTransformation.__init__(self, token)
 
-    def _update(self, done, not_done):
+    def _update(self, done, not_done, context):
         if self._mode != "v":
             # Keep the indent for Line/Block Selection
             text_before = _vim.buf[self.start.line][:self.start.col]
             indent = self.__REPLACE_NON_WS.sub(" ", text_before)
-            iu = IndentUtil()
+            iu = context.indent
             indent = iu.indent_to_spaces(indent)
             indent = iu.spaces_to_indent(indent)
             text = ""
@@ -35,6 +35,7 @@ import unittest
 import time
 import re
 import platform
+import shutil
 import sys
 
 from textwrap import dedent
@@ -503,6 +504,75 @@ endsnippet
     keys = "ab" + EX
     wanted = "x first a bob b y"
 # End: Snippet Definition Parsing  #}}}
+# Changed Snippet Files  {{{#
+class _ChangedSnippetFile(_VimTest):
+    """Loads a snippet file, changes it on disk and expands from it."""
+    options = ()
+    wait = 0.5
+
+    def _write(self, content):
+        f = open(os.path.join(self.dir, "UltiSnips", "all.snippets"), "w")
+        f.write(dedent(content))
+        f.close()
+
+    def _options_on(self):
+        self.dir = tempfile.mkdtemp(prefix="UltiSnips_Test")
+        os.mkdir(os.path.join(self.dir, "UltiSnips"))
+        self._write("""
+            snippet wtest
+            version 1
+            endsnippet
+            """)
+        for name, value in self.options:
+            self.send(":let %s=%s\n" % (name, value))
+        self.send(":set runtimepath+=%s\n" % self.dir)
+        self.send(":let g:UltiSnipsSnippetDirectories=['UltiSnips']\n")
+        self.send_py("UltiSnips_Manager._ensure_all_loaded()")
+        time.sleep(self.wait)
+        self._write("""
+            snippet wtest
+            version 2, now longer
+            endsnippet
+            """)
+        time.sleep(self.wait)
+
+    def _options_off(self):
+        for name, value in self.options:
+            self.send(":unlet %s\n" % name)
+        self.send(":set runtimepath-=%s\n" % self.dir)
+        shutil.rmtree(self.dir)
+
+class ChangedSnippetFile_IsReloaded(_ChangedSnippetFile):
+    keys = "wtest" + EX
+    wanted = "version 2, now longer"
+
+class ChangedSnippetFile_IsReloadedWithWatcher(_ChangedSnippetFile):
+    options = (("g:UltiSnipsWatchSnippetFiles", "1"),
+            ("g:UltiSnipsCheckInterval", "0.1"))
+    wait = 1.5
+    keys = "wtest" + EX
+    wanted = "version 2, now longer"
+
+class ChangedSnippetDirectories_IsReloadedWithWatcher(_ChangedSnippetFile):
+    """The snippets are loaded before the directory is in 'runtimepath'."""
+    options = (("g:UltiSnipsWatchSnippetFiles", "1"),)
+    keys = "wtest" + EX
+    wanted = "version 1"
+
+    def _options_on(self):
+        self.dir = tempfile.mkdtemp(prefix="UltiSnips_Test")
+        os.mkdir(os.path.join(self.dir, "UltiSnips"))
+        self._write("""
+            snippet wtest
+            version 1
+            endsnippet
+            """)
+        for name, value in self.options:
+            self.send(":let %s=%s\n" % (name, value))
+        self.send(":let g:UltiSnipsSnippetDirectories=['UltiSnips']\n")
+        self.send_py("UltiSnips_Manager._ensure_all_loaded()")
+        self.send(":set runtimepath+=%s\n" % self.dir)
+# End: Changed Snippet Files  #}}}
 
 # Simple Expands  {{{#
 class _SimpleExpands(_VimTest):
@@ -531,6 +601,15 @@ class SimpleExpandTypeAndDelete_ExceptCorrectResult(_SimpleExpands):
     keys = "na du hallo" + EX + "and again\b\b\b\b\bblub"
     wanted = "na du Hallo Welt!and blub"
 
+class ExpandThenType_FirstKeyUpdatesMirror(_VimTest):
+    snippets = ("test", "${1:a} $1 end")
+    keys = "test" + EX + "x"
+    wanted = "x x end"
+class ExpandThenType_EmptyTabstop(_VimTest):
+    snippets = ("test", "$1 $1end")
+    keys = "test" + EX + "abc\b"
+    wanted = "ab abend"
+
 class DoNotExpandAfterSpace_ExceptCorrectResult(_SimpleExpands):
     keys = "hallo " + EX
     wanted = "hallo " + EX
@@ -845,6 +924,21 @@ print "Hallo Welt"
 `} end""")
     keys = "test" + EX + JF + "and more"
     wanted = "Hallo now Hallo Welt endand more"
+
+class _AsyncShellCode(_VimTest):
+    skip_on_windows = True
+    def _options_on(self):
+        self.send(":let g:UltiSnipsAsyncShellCode=1\n")
+    def _options_off(self):
+        self.send(":unlet g:UltiSnipsAsyncShellCode\n")
+class TabStop_Shell_Async_NoTabstops(_AsyncShellCode):
+    snippets = ("test", "hi `sleep 0.3; echo hallo` you!")
+    keys = "test" + EX + "and more"
+    wanted = "hi hallo you!and more"
+class TabStop_Shell_Async_LeftBeforeCommandEnds(_AsyncShellCode):
+    snippets = ("test", "${1:Hallo} `sleep 0.3; echo hallo` end")
+    keys = "test" + EX + JF + "and more"
+    wanted = "Hallo hallo endand more"
 # End: ShellCode Interpolation  #}}}
 # VimScript Interpolation  {{{#
 class TabStop_VimScriptInterpolation_SimpleExample(_VimTest):
@@ -1175,6 +1269,42 @@ class PythonVisual_LineSelect_Simple(_VimTest):
     keys = "hello\nnice\nworld" + ESC + "Vkk" + EX + "test" + EX
     wanted = "hVhello\nnice\nworld\nb"
 
+class PythonCode_ReadsSnipC_RunsUntilSettled(_VimTest):
+    snippets = ("test", "`!p snip.rv = snip.c + '.' if len(snip.c) < 3 else snip.c`")
+    keys = "test" + EX
+    wanted = "..."
+class PythonCode_ReadsCur_RunsUntilSettled(_VimTest):
+    snippets = ("test", "`!p snip.rv = cur + '.' if len(cur) < 3 else cur`")
+    keys = "test" + EX
+    wanted = "..."
+class PythonCode_Pure_FollowsTabstop(_VimTest):
+    snippets = ("test", "${1:a} `!p snip.rv = t[1].upper()` ${2:b}")
+    keys = "test" + EX + "xyz" + JF + "c"
+    wanted = "xyz XYZ c"
+
+class _PythonCode_VimVariable(_VimTest):
+    def _options_on(self):
+        self.send(":let g:UltiSnipsTestVar='one'\n")
+    def _options_off(self):
+        self.send(":unlet g:UltiSnipsTestVar\n")
+class PythonCode_AsksVim_RunsAgain(_PythonCode_VimVariable):
+    snippets = ("test", "${1:a} `!p snip.rv = snip.opt('g:UltiSnipsTestVar')`")
+    keys = "test" + EX + "x" + ESC + ":let g:UltiSnipsTestVar='two'\n" + "ay"
+    wanted = "xy two"
+class PythonCode_GlobalFunctionAsksVim_RunsAgain(_PythonCode_VimVariable):
+    snippets_test_file = ("all", "test_file", r"""
+        global !p
+        def var():
+            return vim.eval("g:UltiSnipsTestVar")
+        endglobal
+
+        snippet test
+        ${1:a} `!p snip.rv = var()`
+        endsnippet
+        """)
+    keys = "test" + EX + "x" + ESC + ":let g:UltiSnipsTestVar='two'\n" + "ay"
+    wanted = "xy two"
+
 # End: New Implementation  #}}}
 # End: PythonCode Interpolation  #}}}
 # Mirrors  {{{#
@@ -1365,6 +1495,15 @@ class Mirror_TestKillTabstop_Kill(_VimTest):
     keys = "hallo test" + EX + "elt"
     wanted = "hallo weltelt "
 
+class Mirror_BeforeSelfReferencingTabstop(_VimTest):
+    snippets = "test", "$2 ${1:$1} ${2:a}"
+    keys = "test" + EX
+    wanted = "a  a"
+class Mirror_TransformationBeforeSelfReferencingTabstop(_VimTest):
+    snippets = "test", "$2${1/a/X/g}${2:c}${1:$1}"
+    keys = "test" + EX
+    wanted = "cc"
+
 # End: Mirrors  #}}}
 # Transformations  {{{#
 class Transformation_SimpleCase_ExceptCorrectResult(_VimTest):